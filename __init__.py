@@ -1,19 +1,43 @@
 import os
 import re
 import json
+import fnmatch
 import importlib
 from typing import List, Dict, Optional, Callable, Tuple, Any
 import cudatext as app
+import cudatext_cmd as cmds
 from cudatext import ed
 from .fmtconfig import *
 from .fmtrun import *
+from . import fmtconfig, fmtrun, fmtdaemon, fmtreplay
 
 from cudax_lib import get_translation, get_opt
 _   = get_translation(__file__)  # i18n
 
 FN_CFG = os.path.join(app.app_path(app.APP_DIR_SETTINGS), 'cuda_fmt.json')
+FN_COSTS = os.path.join(app.app_path(app.APP_DIR_SETTINGS), 'cuda_fmt_costs.json')
+FN_SPEED = os.path.join(app.app_path(app.APP_DIR_SETTINGS), 'cuda_fmt_speed.json')
 MAX_FORMATTERS_PER_PLUGIN = 100
 README_PATH = os.path.join('readme', 'readme.txt')
+DIR_WORKLOAD = os.path.join(app.app_path(app.APP_DIR_SETTINGS), 'cuda_fmt_workload')
+
+# options from cuda_fmt.json (key "options")
+options = {
+    'on_save_budget_ms': 0,          # 0: no time budget for on_save formatting
+    'on_save_over_budget': 'skip',   # 'skip' or 'defer' (format after the save)
+    'on_type_delay_ms': 1000,        # pause after on_change_slow, before formatting edited lines
+    'daemon_idle_sec': 300,          # idle formatter daemons are closed after this time
+    'speculative': False,            # format opened/edited documents in the background
+    'speculative_max_kb': 4096,      # max document size for background formatting
+    'chunks_min_kb': 1024,           # min document size to format by chunks, for formatters with "chunks="
+    'long_line_chars': 1000,         # changed lines longer than this are changed by character hunks
+    'max_format_sec': 0,             # formatters which are predicted to run longer are not used; 0: no limit
+    'record_workload': 0,            # 1: record descriptors of formatting calls, 2: also their texts
+}
+MAX_TYPED_KNOWN = 1000
+
+# module name -> Command object of formatter plugin, to not create it on each call
+_command_instances = {}
 
 def _call_method_by_name(module: Any, method_name: str) -> None:
     """Call a method from module by name with automatic Command fallback.
@@ -21,6 +45,7 @@ def _call_method_by_name(module: Any, method_name: str) -> None:
     Strategy (KISS principle):
     1. Try module-level function first: module.method_name()
     2. If not found, try Command class: module.Command().method_name()
+       (Command object is created once per module)
 
     This ensures backward compatibility with simple functions while
     supporting class-based plugins without requiring wrapper functions.
@@ -50,9 +75,12 @@ def _call_method_by_name(module: Any, method_name: str) -> None:
     # Try 2: Method in Command class (common pattern in CudaText plugins)
     if hasattr(module, 'Command'):
         cmd_class = getattr(module, 'Command')
-        # Instantiate Command class
+        # Instantiate Command class once
         if isinstance(cmd_class, type):
-            cmd_instance = cmd_class()
+            cmd_instance = _command_instances.get(module.__name__)
+            if not isinstance(cmd_instance, cmd_class):
+                cmd_instance = cmd_class()
+                _command_instances[module.__name__] = cmd_instance
             if hasattr(cmd_instance, method_name):
                 method = getattr(cmd_instance, method_name)
                 if callable(method):
@@ -102,6 +130,10 @@ class Helpers:
     Priority: [fmtX] > [info] > legacy config=
     """
     helpers = []
+    plugin_stamps = {}  # plugin folder -> stamp of its files, to find changed plugins
+    fallbacks = {}      # lexer -> caption of formatter for too big documents
+    name_lexers = {}    # file name pattern -> lexer, for editors without lexer
+    name_index = None   # (names, extensions, wildcard patterns), built from name_lexers
 
     @staticmethod
     def get_editor_lexer() -> Optional[str]:
@@ -121,8 +153,13 @@ class Helpers:
 
         lexer0 = ed.get_prop(app.PROP_LEXER_FILE)
         if not lexer0:
-            error_max_size = False
             fn = ed.get_filename()
+            lexer0 = helpers.lexer_by_filename(fn)
+            if lexer0:
+                # no sub-lexers without lexer
+                return lexer0
+
+            error_max_size = False
             if fn:
                 try:
                     size = os.path.getsize(fn)
@@ -163,6 +200,129 @@ class Helpers:
 
         return lexer1
 
+    def set_name_lexers(self, data: Dict[str, str]) -> None:
+        """Set patterns of file names to resolve lexer of files without lexer.
+
+        Args:
+            data: Dict of pattern -> lexer, pattern is file name ("Makefile"),
+                extension ("*.json", "*.min.js") or other fnmatch pattern
+        """
+        self.name_lexers = data
+        self.name_index = None
+
+    def build_name_index(self) -> Tuple[Dict[str, str], Dict[str, str], List[Tuple[str, str]]]:
+        """Index name patterns, so usual patterns are found by dict lookup.
+
+        Returns:
+            Tuple of (names, extensions, wildcard patterns), all lowercase
+        """
+        names = {}
+        exts = {}
+        patterns = []
+        for pattern, lexer in self.name_lexers.items():
+            pattern = pattern.lower()
+            if not any(c in pattern for c in '*?['):
+                names[pattern] = lexer
+            elif pattern.startswith('*.') and not any(c in pattern[2:] for c in '*?['):
+                exts[pattern[2:]] = lexer
+            else:
+                patterns.append((pattern, lexer))
+        return (names, exts, patterns)
+
+    def lexer_by_filename(self, fn: str) -> Optional[str]:
+        """Resolve lexer by file name, for editor without lexer (e.g. lexer is
+        disabled for big file by "ui_max_size_lexer").
+
+        Patterns from key "lexers_by_name" of cuda_fmt.json are checked first,
+        then lexer detection of CudaText.
+
+        Args:
+            fn: File name
+
+        Returns:
+            Lexer name which has formatters, or None
+        """
+        if not fn:
+            return None
+
+        if self.name_index is None:
+            self.name_index = self.build_name_index()
+        names, exts, patterns = self.name_index
+
+        name = os.path.basename(fn).lower()
+        lexer = names.get(name)
+        if lexer is None:
+            # longest extension first: "a.min.js" -> "min.js", "js"
+            parts = name.split('.')
+            for i in range(1, len(parts)):
+                lexer = exts.get('.'.join(parts[i:]))
+                if lexer:
+                    break
+        if lexer is None:
+            for pattern, item in patterns:
+                if fnmatch.fnmatchcase(name, pattern):
+                    lexer = item
+                    break
+
+        candidates = [lexer] if lexer else []
+        if not candidates:
+            detected = app.lexer_proc(app.LEXER_DETECT, fn)
+            if isinstance(detected, str):
+                candidates = [detected]
+            elif detected:
+                candidates = list(detected)
+
+        for lexer in candidates:
+            if self.helpers_for_lexer(lexer):
+                return lexer
+        return None
+
+    def get_file_lexer(self, ed_self: Any) -> Optional[str]:
+        """Get lexer of editor; for editor without lexer, resolve it by file name.
+
+        Args:
+            ed_self: Editor instance
+
+        Returns:
+            Lexer name or None
+        """
+        lexer = ed_self.get_prop(app.PROP_LEXER_FILE)
+        if lexer:
+            return lexer
+        return self.lexer_by_filename(ed_self.get_filename())
+
+    def get_auto_lexer(self, ed_self: Any, budget: bool = False) -> Optional[str]:
+        """Get lexer of editor for automatic formatting (on_save, after save, all tabs).
+
+        Editor without lexer is usually a big file, so lexer resolved by file
+        name is used only if formatting time is limited: by time budget, by
+        option "max_format_sec", or by "max_size" of all formatters for the
+        lexer. Otherwise file size must not exceed "ui_max_size_lexer".
+
+        Args:
+            ed_self: Editor instance
+            budget: Time budget is applied by the caller
+
+        Returns:
+            Lexer name or None
+        """
+        lexer = ed_self.get_prop(app.PROP_LEXER_FILE)
+        if lexer:
+            return lexer
+        lexer = self.lexer_by_filename(ed_self.get_filename())
+        if not lexer:
+            return None
+
+        if budget or options.get('max_format_sec'):
+            return lexer
+        if all(h.get('max_size') for h in self.helpers_for_lexer(lexer)):
+            return lexer
+        size = get_text_size(ed_self)
+        if size > get_opt('ui_max_size_lexer', 2) * 1024 * 1024:
+            app.msg_status(_('File without lexer is too big ({} Kb) for auto-formatting').format(size // 1024))
+            return None
+        return lexer
+
     def lexers(self) -> List[str]:
         """Get sorted list of all supported lexers.
 
@@ -209,67 +369,171 @@ class Helpers:
         Args:
             plugin_dir: Path to plugins directory
         """
+        for formatter_dir in self.plugin_dirs(plugin_dir):
+            self.helpers.extend(self.load_plugin(formatter_dir))
+
+    @staticmethod
+    def plugin_dirs(plugin_dir: str) -> List[str]:
+        """Get sorted list of formatter plugin folders."""
         dirs = os.listdir(plugin_dir)
         dirs = [os.path.join(plugin_dir, s) for s in dirs if s.startswith('cuda_fmt_')]
-        dirs = sorted(dirs)
-
-        for formatter_dir in dirs:
-            fn_inf = os.path.join(formatter_dir, 'install.inf')
-            s_module = app.ini_read(fn_inf, 'info', 'subdir', '')
-
-            # Read global defaults from [info] section
-            global_config = app.ini_read(fn_inf, 'info', 'config', '')
-            global_config_global = app.ini_read(fn_inf, 'info', 'config_global', '')
-            global_config_local = app.ini_read(fn_inf, 'info', 'config_local', '')
-            global_help = app.ini_read(fn_inf, 'info', 'help', '')
-
-            for index in range(1, MAX_FORMATTERS_PER_PLUGIN):
-                section = 'fmt'+str(index)
-                s_method = app.ini_read(fn_inf, section, 'method', '')
-                if not s_method: break
-                s_lexers = app.ini_read(fn_inf, section, 'lexers', '')
-                if not s_lexers: break
-                s_caption = app.ini_read(fn_inf, section, 'caption', '')
-                if not s_caption: break
-
-                # Legacy mode: config= (file-based)
-                s_config = app.ini_read(fn_inf, section, 'config', '')
-
-                # New mode: config_global=/config_local=/help= (method-based)
-                s_config_global = app.ini_read(fn_inf, section, 'config_global', '')
-                s_config_local = app.ini_read(fn_inf, section, 'config_local', '')
-                s_help = app.ini_read(fn_inf, section, 'help', '')
-
-                # Inherit from [info] if not specified in [fmtX]
-                if not s_config and not s_config_global:
-                    s_config = global_config
-                    s_config_global = global_config_global
-                if not s_config_local:
-                    s_config_local = global_config_local
-                if not s_help:
-                    s_help = global_help
-
-                force_all = app.ini_read(fn_inf, section, 'force_all', '') == '1'
-                minifier = app.ini_read(fn_inf, section, 'minifier', '') == '1'
-
-                helper = {
-                        'dir': formatter_dir,
-                        'module': s_module,
-                        'method': s_method,
-                        'func': None,
-                        'lexers': s_lexers,
-                        'caption': s_caption,
-                        'config': s_config,  # Legacy: config file name
-                        'config_global': s_config_global,  # New: method name
-                        'config_local': s_config_local,    # New: method name
-                        'help': s_help,                    # New: method name
-                        'force_all': force_all,
-                        'minifier': minifier,
-                        'label': None,
-                        'on_save': False,
-                        }
-
-                self.helpers.append(helper)
+        return sorted(dirs)
+
+    @staticmethod
+    def plugin_stamp(formatter_dir: str) -> Optional[Tuple[int, ...]]:
+        """Get stamp of plugin files (install.inf and __init__.py), to find changed plugins.
+
+        Returns:
+            Tuple of mtimes/sizes, or None if install.inf is missing
+        """
+        res = ()
+        for fn in ('install.inf', '__init__.py'):
+            try:
+                st = os.stat(os.path.join(formatter_dir, fn))
+            except OSError:
+                if fn == 'install.inf':
+                    return None
+                continue
+            res += (st.st_mtime_ns, st.st_size)
+        return res
+
+    def load_plugin(self, formatter_dir: str) -> List[Dict[str, Any]]:
+        """Read formatters of one plugin from its install.inf.
+
+        Args:
+            formatter_dir: Path to plugin folder
+
+        Returns:
+            List of helper dicts
+        """
+        res = []
+        self.plugin_stamps[formatter_dir] = self.plugin_stamp(formatter_dir)
+        fn_inf = os.path.join(formatter_dir, 'install.inf')
+        s_module = app.ini_read(fn_inf, 'info', 'subdir', '')
+
+        # Read global defaults from [info] section
+        global_config = app.ini_read(fn_inf, 'info', 'config', '')
+        global_config_global = app.ini_read(fn_inf, 'info', 'config_global', '')
+        global_config_local = app.ini_read(fn_inf, 'info', 'config_local', '')
+        global_help = app.ini_read(fn_inf, 'info', 'help', '')
+
+        for index in range(1, MAX_FORMATTERS_PER_PLUGIN):
+            section = 'fmt'+str(index)
+            s_method = app.ini_read(fn_inf, section, 'method', '')
+            if not s_method: break
+            s_method_batch = app.ini_read(fn_inf, section, 'method_batch', '')
+            s_lexers = app.ini_read(fn_inf, section, 'lexers', '')
+            if not s_lexers: break
+            s_caption = app.ini_read(fn_inf, section, 'caption', '')
+            if not s_caption: break
+
+            # Legacy mode: config= (file-based)
+            s_config = app.ini_read(fn_inf, section, 'config', '')
+
+            # New mode: config_global=/config_local=/help= (method-based)
+            s_config_global = app.ini_read(fn_inf, section, 'config_global', '')
+            s_config_local = app.ini_read(fn_inf, section, 'config_local', '')
+            s_help = app.ini_read(fn_inf, section, 'help', '')
+
+            # Inherit from [info] if not specified in [fmtX]
+            if not s_config and not s_config_global:
+                s_config = global_config
+                s_config_global = global_config_global
+            if not s_config_local:
+                s_config_local = global_config_local
+            if not s_help:
+                s_help = global_help
+
+            force_all = app.ini_read(fn_inf, section, 'force_all', '') == '1'
+            minifier = app.ini_read(fn_inf, section, 'minifier', '') == '1'
+            stream = app.ini_read(fn_inf, section, 'stream', '') == '1'
+            chunks = app.ini_read(fn_inf, section, 'chunks', '')
+            s_class = app.ini_read(fn_inf, section, 'class', '')
+            max_size = parse_size(app.ini_read(fn_inf, section, 'max_size', ''))
+            speed = app.ini_read(fn_inf, section, 'speed', '')
+            threads = app.ini_read(fn_inf, section, 'threads', '') == '1'
+
+            helper = {
+                    'dir': formatter_dir,
+                    'module': s_module,
+                    'method': s_method,
+                    'method_batch': s_method_batch,
+                    'class': s_class,
+                    'func': None,
+                    'lexers': s_lexers,
+                    'caption': s_caption,
+                    'config': s_config,  # Legacy: config file name
+                    'config_global': s_config_global,  # New: method name
+                    'config_local': s_config_local,    # New: method name
+                    'help': s_help,                    # New: method name
+                    'force_all': force_all,
+                    'minifier': minifier,
+                    'stream': stream,
+                    'chunks': chunks,
+                    'max_size': max_size,
+                    'speed': speed,
+                    'threads': threads,
+                    'label': None,
+                    'on_save': False,
+                    'on_type': False,
+                    }
+
+            res.append(helper)
+        return res
+
+    def unload_plugin(self, formatter_dir: str) -> None:
+        """Remove formatters of plugin, and forget its imported modules.
+
+        Args:
+            formatter_dir: Path to plugin folder
+        """
+        self.plugin_stamps.pop(formatter_dir, None)
+        items = [h for h in self.helpers if h.get('dir') == formatter_dir]
+        self.teardown(items)
+        modules = set(h.get('module') for h in items)
+        self.helpers[:] = [h for h in self.helpers if h.get('dir') != formatter_dir]
+
+        for name in modules:
+            if not name:
+                continue
+            _command_instances.pop(name, None)
+            for key in list(importlib.sys.modules):
+                if key == name or key.startswith(name + '.'):
+                    del importlib.sys.modules[key]
+
+    def rescan(self, plugin_dir: str) -> Tuple[List[Dict[str, Any]], int]:
+        """Reload only added/removed/changed plugins, found by stat of install.inf/__init__.py.
+
+        Pipelines are kept, and they will get fresh functions of their steps.
+
+        Args:
+            plugin_dir: Path to plugins directory
+
+        Returns:
+            Tuple of (list of new helpers, count of changed plugins)
+        """
+        dirs = self.plugin_dirs(plugin_dir)
+        changed = [d for d in self.plugin_stamps if d not in dirs]
+        changed += [d for d in dirs if self.plugin_stamp(d) != self.plugin_stamps.get(d)]
+        if not changed:
+            return ([], 0)
+
+        new_items = []
+        for d in changed:
+            self.unload_plugin(d)
+            if d in dirs:
+                new_items += self.load_plugin(d)
+
+        # keep order of load_dir: plugins sorted by folder, then pipelines
+        items = [h for h in self.helpers if not h.get('pipeline')] + new_items
+        items.sort(key=lambda h: h.get('dir', ''))
+        pipelines = [h for h in self.helpers if h.get('pipeline')]
+        for h in pipelines:
+            h['func'] = None
+        self.helpers[:] = items + pipelines
+
+        importlib.invalidate_caches()
+        return (new_items, len(changed))
 
     def get_item_props(self, helper: Dict[str, Any]) -> Tuple[Callable, str, bool]:
         """Get formatter properties and ensure function is loaded.
@@ -278,7 +542,8 @@ class Helpers:
             helper: Formatter dictionary with module/method info
 
         Returns:
-            Tuple of (func, caption, force_all)
+            Tuple of (func, caption, force_all); func is Formatter object,
+            callable as text -> text
 
         Raises:
             AttributeError: If method not found in module
@@ -289,6 +554,17 @@ class Helpers:
         caption = helper.get('caption', 'Unknown')
         force_all = helper.get('force_all', False)
 
+        if func is None and helper.get('pipeline'):
+            funcs = []
+            for step in helper['pipeline']:
+                items = [h for h in self.helpers if h.get('caption') == step and not h.get('pipeline')]
+                if not items:
+                    raise ValueError(f'Pipeline "{caption}" has unknown formatter "{step}"')
+                funcs.append(self.get_item_props(items[0])[0])
+            func = Formatter(Pipeline(funcs), key=self.helper_key(helper),
+                threads=all(f.threads for f in funcs))
+            helper['func'] = func
+
         if func is None:
             module_name = helper.get('module')
             method_name = helper.get('method')
@@ -297,24 +573,186 @@ class Helpers:
                 raise ValueError(f'Helper missing module or method: {helper}')
 
             _m = _import_module_cached(module_name)
-            func = getattr(_m, method_name)
+            method_batch = helper.get('method_batch')
+
+            # class-based formatter: object is created once, methods are taken from it
+            class_name = helper.get('class')
+            if class_name:
+                instance = getattr(_m, class_name)()
+                owner = instance
+            else:
+                instance = None
+                owner = _m
+
+            func = Formatter(
+                getattr(owner, method_name),
+                key=self.helper_key(helper),
+                stream=helper.get('stream', False),
+                batch=getattr(owner, method_batch) if method_batch else None,
+                chunks=helper.get('chunks', ''),
+                instance=instance,
+                speed=helper.get('speed', ''),
+                threads=helper.get('threads', False),
+                )
             helper['func'] = func
 
         return (func, caption, force_all)
 
-    def get_props(self, lexer: str) -> Optional[Tuple[Callable, str, bool]]:
+    @staticmethod
+    def helper_key(helper: Dict[str, Any]) -> str:
+        """Get key of formatter for statistics, without loading it."""
+        if helper.get('pipeline'):
+            return 'pipeline:' + helper.get('caption', '')
+        parts = [helper.get('module', ''), helper.get('class', ''), helper.get('method', '')]
+        return '.'.join(p for p in parts if p)
+
+    def fits_size(self, helper: Dict[str, Any], size: int) -> bool:
+        """Check that formatter can handle document of given size.
+
+        Args:
+            helper: Formatter dict
+            size: Document size in chars
+
+        Returns:
+            False if size exceeds "max_size" of formatter, or if predicted time
+            (by measured speed or by "speed" class) exceeds option "max_format_sec"
+        """
+        max_size = helper.get('max_size', 0)
+        if max_size and size > max_size:
+            return False
+
+        limit = options.get('max_format_sec', 0)
+        if limit:
+            t = predict_time(self.helper_key(helper), size, helper.get('speed', ''))
+            if t is not None and t > limit:
+                return False
+        return True
+
+    def route_by_size(self, lexer: str, items: List[Dict[str, Any]], ed_self: Any) -> List[Dict[str, Any]]:
+        """Filter formatters which can handle the document size; if none of them
+        can, use fallback formatter for this lexer.
+
+        Args:
+            lexer: Lexer name
+            items: Formatter dicts
+            ed_self: Editor instance
+
+        Returns:
+            List of formatter dicts, empty list if document is too big
+            (status bar message is shown then)
+        """
+        if not options.get('max_format_sec') and not any(h.get('max_size') for h in items):
+            return items
+
+        size = get_text_size(ed_self)
+        res = [h for h in items if self.fits_size(h, size)]
+        if res:
+            return res
+
+        caption = self.fallbacks.get(lexer)
+        res = [h for h in self.helpers if caption and h.get('caption') == caption and self.fits_size(h, size)]
+        if res:
+            return res
+
+        app.msg_status(_('Document is too big ({} Kb) for formatters of "{}"').format(size // 1024, lexer))
+        return []
+
+    def invalidate(self, items: List[Dict[str, Any]]) -> None:
+        """Tell loaded formatters that their config is changed.
+
+        Args:
+            items: Helper dicts
+        """
+        # documents formatted with the old config may need formatting again
+        clear_format_states()
+        for helper in items:
+            func = helper.get('func')
+            if func and not helper.get('pipeline'):
+                try:
+                    func.invalidate()
+                except Exception as e:
+                    print(_('Formatter "%s" failed on invalidate: %s') % (helper.get('caption'), e))
+
+    def teardown(self, items: List[Dict[str, Any]]) -> None:
+        """Close loaded formatters and forget them, they will be created again on next use.
+
+        Args:
+            items: Helper dicts
+        """
+        for helper in items:
+            func = helper.get('func')
+            helper['func'] = None
+            if func and not helper.get('pipeline'):
+                try:
+                    func.close()
+                except Exception as e:
+                    print(_('Formatter "%s" failed on close: %s') % (helper.get('caption'), e))
+
+    def load_pipelines(self, data: Dict[str, Any]) -> None:
+        """Add pipelines from config as formatters, replacing old ones.
+
+        Pipeline is configured as:
+            "pipelines": {
+                "caption": {"steps": ["caption1", "caption2"], "lexers": "Python"}
+            }
+        If "lexers" is missing, lexers of the first step are used.
+
+        Args:
+            data: Value of "pipelines" config key
+        """
+        self.helpers[:] = [h for h in self.helpers if not h.get('pipeline')]
+
+        for caption, item in data.items():
+            steps = item.get('steps') or []
+            if not steps:
+                continue
+
+            step_helpers = [h for h in self.helpers if h.get('caption') in steps]
+            lexers = item.get('lexers')
+            if not lexers:
+                lexers = ','.join(h.get('lexers', '') for h in step_helpers if h.get('caption') == steps[0])
+
+            helper = {
+                    'dir': '',
+                    'module': '',
+                    'method': '',
+                    'func': None,
+                    'lexers': lexers,
+                    'caption': caption,
+                    'config': '',
+                    'config_global': '',
+                    'config_local': '',
+                    'help': '',
+                    'force_all': any(h.get('force_all') for h in step_helpers),
+                    'minifier': False,
+                    'stream': False,
+                    'pipeline': steps,
+                    'label': None,
+                    'on_save': False,
+                    'on_type': False,
+                    }
+            self.helpers.append(helper)
+
+    def get_props(self, lexer: str, ed_self: Any = None) -> Optional[Tuple[Callable, str, bool]]:
         """Get formatter properties for lexer.
 
         Args:
             lexer: Lexer name to search for
+            ed_self: Editor instance, to route document by its size
 
         Returns:
-            Tuple of (func, caption, force_all) or None if no formatter/user cancelled
+            Tuple of (func, caption, force_all) or None if no formatter/user cancelled,
+            or False if document is too big for formatters
         """
         d = self.helpers_for_lexer(lexer)
         if not d:
             return None
 
+        if ed_self:
+            d = self.route_by_size(lexer, d, ed_self)
+            if not d:
+                return False
+
         if len(d) == 1:
             item = d[0]
         else:
@@ -326,20 +764,75 @@ class Helpers:
 
         return self.get_item_props(item)
 
-    def get_props_on_save(self, lexer: str) -> Optional[Tuple[Callable, str, bool]]:
+    def get_props_on_save(self, lexer: str, ed_self: Any = None) -> Optional[Tuple[Callable, str, bool]]:
         """Get formatter properties for on_save event.
 
         Args:
             lexer: Lexer name
+            ed_self: Editor instance, to route document by its size
 
         Returns:
-            Tuple of (func, caption, force_all) or None if no formatter with on_save
+            Tuple of (func, caption, force_all) or None if no formatter with on_save,
+            or False if document is too big for formatters
         """
         d = self.helpers_for_lexer(lexer)
         if not d:
             return None
 
         d = [h for h in d if h.get('on_save')]
+        if not d:
+            return None
+
+        if ed_self:
+            d = self.route_by_size(lexer, d, ed_self)
+            if not d:
+                return False
+        return self.get_item_props(d[0])
+
+    def get_props_auto(self, lexer: str, ed_self: Any = None) -> Optional[Tuple[Callable, str, bool]]:
+        """Get formatter properties for lexer, without asking the user.
+
+        Prefers formatter with on_save flag, then formatter with label 'A',
+        then the first one.
+
+        Args:
+            lexer: Lexer name
+            ed_self: Editor instance, to route document by its size
+
+        Returns:
+            Tuple of (func, caption, force_all) or None if no formatter,
+            or False if document is too big for formatters
+        """
+        d = self.helpers_for_lexer(lexer)
+        if not d:
+            return None
+
+        if ed_self:
+            d = self.route_by_size(lexer, d, ed_self)
+            if not d:
+                return False
+
+        for key, value in (('on_save', True), ('label', 'A')):
+            for h in d:
+                if h.get(key) == value:
+                    return self.get_item_props(h)
+        return self.get_item_props(d[0])
+
+    def get_props_on_type(self, lexer: str) -> Optional[Tuple[Callable, str, bool]]:
+        """Get formatter properties for formatting of edited lines.
+
+        Args:
+            lexer: Lexer name
+
+        Returns:
+            Tuple of (func, caption, force_all) or None if no formatter with on_type
+        """
+        d = self.helpers_for_lexer(lexer)
+        if not d:
+            return None
+
+        # force_all formatters cannot handle fragments of text
+        d = [h for h in d if h.get('on_type') and not h.get('force_all')]
         if not d:
             return None
         return self.get_item_props(d[0])
@@ -348,11 +841,12 @@ helpers = Helpers()
 helpers.load_dir(app.app_path(app.APP_DIR_PY))
 print(_('Formatters: ') + ', '.join(helpers.lexers()))
 
-def get_config_filename(caption: str) -> Optional[str]:
+def get_config_filename(caption: str, filename: Optional[str] = None) -> Optional[str]:
     """Get current config filename for formatter by caption.
 
     Args:
         caption: Formatter caption to search for
+        filename: Editor file to find local config for (default: file being formatted)
 
     Returns:
         Path to config file or None if not found
@@ -364,15 +858,117 @@ def get_config_filename(caption: str) -> Optional[str]:
             config_dir = helper.get('dir', '')
             if config_dir:
                 cfg = FmtConfig(config_file, config_dir)
-                return cfg.current_filename()
+                return cfg.current_filename(filename)
+    return None
+
+def get_config(caption: str,
+               parser: Optional[Callable[[str], Any]] = None,
+               filename: Optional[str] = None) -> Any:
+    """Get parsed config of formatter by caption, cached by path and mtime.
+
+    Formatters can call it on each format call: config file is parsed again
+    only when it (or the choice of local/global config) changes.
+    Returned object is shared, so it must not be modified by the caller.
+
+    Args:
+        caption: Formatter caption to search for
+        parser: Function(config_filename) -> parsed object; by default it's
+            chosen by file extension (JSON, INI, or plain text)
+        filename: Editor file to find local config for (default: file being formatted)
+
+    Returns:
+        Parsed config object or None if formatter has no config file
+    """
+    fn = get_config_filename(caption, filename)
+    if not fn:
+        return None
+    return config_cache.get(fn, parser)
+
+def get_config_stamp(caption: str, filename: Optional[str] = None) -> Optional[Tuple[str, int]]:
+    """Get stamp of current config file of formatter, to find config changes.
+
+    Args:
+        caption: Formatter caption
+        filename: Editor file to find local config for
+
+    Returns:
+        Tuple of (config filename, mtime) or None if formatter has no config file
+    """
+    fn = get_config_filename(caption, filename)
+    if not fn:
+        return None
+    try:
+        return (fn, os.stat(fn).st_mtime_ns)
+    except OSError:
+        return (fn, 0)
+
+def get_formatter_config_stamp(do_format: Callable, filename: str) -> Optional[Tuple[str, int]]:
+    """Get stamp of config file of formatter object, see get_config_stamp.
+
+    Args:
+        do_format: Formatter object
+        filename: Editor file to find local config for
+
+    Returns:
+        Tuple of (config filename, mtime) or None if formatter has no config file
+    """
+    key = formatter_key(do_format)
+    for helper in helpers.helpers:
+        if helper.get('config') and helpers.helper_key(helper) == key:
+            return get_config_stamp(helper.get('caption', ''), filename)
     return None
 
+fmtrun.config_stamp = get_formatter_config_stamp
+
 class Command:
 
     def __init__(self) -> None:
 
+        self.deferred = set()  # handles of editors to format after save
+        self.typed = set()     # handles of editors with typing, waiting for debounce timer
+        self.typed_jobs = {}   # editor handle -> (version, blocks, future) of formatting job
+        self.typed_known = {}  # editor handle -> set of texts of already formatted blocks
+        self.spec_jobs = {}    # editor handle -> (text, filename, func, caption, future) of background formatting
+        self.load_costs()
+        self.load_speed()
         self.load_labels()
 
+    def load_costs(self) -> None:
+        """Load calibrated cost model of applying changes, see calibrate_apply."""
+        if not os.path.isfile(FN_COSTS):
+            return
+        try:
+            with open(FN_COSTS, 'r', encoding='utf8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as ex:
+            print('ERROR: CudaFormatter: cannot read costs file:', ex)
+            return
+        fmtrun.apply_costs.update({k: float(v) for k, v in data.items() if k in fmtrun.apply_costs})
+
+    def load_speed(self) -> None:
+        """Load speed of formatters measured in previous sessions, to predict
+        formatting time (on_save budget, size routing) from the first call."""
+        if not os.path.isfile(FN_SPEED):
+            return
+        try:
+            with open(FN_SPEED, 'r', encoding='utf8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as ex:
+            print('ERROR: CudaFormatter: cannot read speed file:', ex)
+            return
+        for key, rate in data.items():
+            speed_stats.setdefault(key, float(rate))
+
+    def save_speed(self) -> None:
+        """Save measured speed of formatters for next sessions."""
+        if not speed_stats:
+            return
+        try:
+            with open(FN_SPEED, 'w', encoding='utf8') as f:
+                json.dump(speed_stats, f, indent=2)
+        except OSError as ex:
+            print('ERROR: CudaFormatter: cannot write speed file:', ex)
+
     def load_labels(self) -> None:
         """Load formatter labels from config file."""
         if not os.path.isfile(FN_CFG):
@@ -381,36 +977,353 @@ class Command:
         with open(FN_CFG, 'r', encoding='utf8') as f:
             all_data = json.load(f)
 
+        data = all_data.get('options')
+        if isinstance(data, dict):
+            options.update(data)
+        fmtdaemon.IDLE_TIMEOUT = options.get('daemon_idle_sec', fmtdaemon.IDLE_TIMEOUT)
+        fmtrun.chunk_min_size = options.get('chunks_min_kb', 1024) * 1024
+        fmtrun.long_line_size = options.get('long_line_chars', 1000)
+        record = options.get('record_workload', 0)
+        fmtrun.recorder = fmtreplay.Recorder(DIR_WORKLOAD, record >= 2) if record else None
+
+        data = all_data.get('pipelines')
+        if isinstance(data, dict):
+            helpers.load_pipelines(data)
+
+        data = all_data.get('fallbacks')
+        if isinstance(data, dict):
+            helpers.fallbacks = data
+
+        data = all_data.get('lexers_by_name')
+        if isinstance(data, dict):
+            helpers.set_name_lexers(data)
+
+        self.apply_labels(all_data, helpers.helpers)
+
+    def apply_labels(self, all_data: Dict[str, Any], items: List[Dict[str, Any]]) -> None:
+        """Set labels/flags of formatters from config data.
+
+        Args:
+            all_data: Content of config file
+            items: Helper dicts to update
+        """
         # Define mappings: config_key -> helper_key
         mappings = [
             ('labels', 'label'),
             ('labels_x', 'label_x'),
             ('on_save', 'on_save'),
+            ('on_type', 'on_type'),
         ]
 
         for config_key, helper_key in mappings:
             data = all_data.get(config_key)
             if data:
                 for caption, value in data.items():
-                    for helper in helpers.helpers:
+                    for helper in items:
                         if helper.get('caption') == caption:
                             helper[helper_key] = value
                             break
 
+    def rescan(self) -> None:
+        """Reload formatter plugins which were installed, updated or removed."""
+
+        new_items, count = helpers.rescan(app.app_path(app.APP_DIR_PY))
+        if not count:
+            app.msg_status(_('Formatters are not changed'))
+            return
+
+        if new_items and os.path.isfile(FN_CFG):
+            with open(FN_CFG, 'r', encoding='utf8') as f:
+                all_data = json.load(f)
+            self.apply_labels(all_data, new_items)
+
+        clear_precomputed()
+        clear_format_states()
+        app.msg_status(_('Reloaded {} formatter plugins').format(count))
+
+    def format_carets(self, label: Optional[str] = None) -> bool:
+        """Format multi-carets/multi-selection: lexer of each selection is found
+        by its position, selections are grouped by formatter, each group is
+        formatted by one batch call, and all is applied in single undo step.
+
+        Args:
+            label: Per-lexer label of formatters, or None to choose formatter
+                for each lexer like Format command does
+
+        Returns:
+            False if there is single caret (not handled), else True
+        """
+        carets = ed.get_carets()
+        if len(carets) < 2:
+            return False
+
+        def get_props(lexer):
+            if label is None:
+                res = helpers.get_props(lexer, ed)
+                if res is None:
+                    app.msg_status(_('No formatters for "%s"')%lexer)
+                return res
+            for helper in helpers.helpers_for_lexer(lexer) or []:
+                if helper.get('label') == label:
+                    routed = helpers.route_by_size(lexer, [helper], ed)
+                    return helpers.get_item_props(routed[0]) if routed else False
+            app.msg_status(_('No formatter for "{}" with label "{}"').format(lexer, label))
+
+        if not is_selected(carets):
+            # carets without selections: entire text
+            lexer = helpers.get_file_lexer(ed)
+            if not lexer:
+                app.msg_status(_('Cannot handle None-lexer'))
+                return True
+            res = get_props(lexer)
+            if res:
+                func, caption, force_all = res
+                run_format(ed, func, '['+caption+'] ', True)
+            return True
+
+        by_lexer = {}
+        noverlap = 0
+        file_lexer = None
+        for sel in get_selections(ed, carets):
+            lexer = get_selection_lexer(ed, *sel[:4])
+            if lexer is None:
+                noverlap += 1
+                continue
+            if not lexer:
+                # editor without lexer: resolve it by file name
+                if file_lexer is None:
+                    file_lexer = helpers.get_file_lexer(ed) or ''
+                if not file_lexer:
+                    app.msg_status(_('Cannot handle None-lexer'))
+                    return True
+                lexer = file_lexer
+            by_lexer.setdefault(lexer, []).append(sel)
+
+        groups = {}  # formatter key -> (func, caption, selections)
+        for lexer, sels in by_lexer.items():
+            res = get_props(lexer)
+            if not res:
+                continue
+            func, caption, force_all = res
+            if force_all:
+                if len(by_lexer) == 1:
+                    run_format(ed, func, '['+caption+'] ', True)
+                    return True
+                app.msg_status(_('[{}] Formatter cannot format selections').format(caption))
+                continue
+            groups.setdefault(formatter_key(func), (func, caption, []))[2].extend(sels)
+
+        if not groups:
+            if noverlap:
+                app.msg_status(_('Selections overlap sub-lexer blocks'))
+            return True
+
+        msg = '['+', '.join(caption for func, caption, sels in groups.values())+'] '
+        run_format_groups(ed, [(func, sels) for func, caption, sels in groups.values()], msg)
+        return True
+
     def format(self) -> None:
         """Format current file/selection using appropriate formatter for lexer."""
 
+        if self.format_carets():
+            return
+
         lexer = Helpers.get_editor_lexer()
         if not lexer:
             return
 
-        res = helpers.get_props(lexer)
+        res = helpers.get_props(lexer, ed)
         if res is None:
             app.msg_status(_('No formatters for "%s"')%lexer)
             return
+        if not res:
+            return
 
         func, caption, force_all = res
-        run_format(ed, func, '['+caption+'] ', force_all)
+        use_all = force_all or not is_selected(ed.get_carets())
+        r = run_format(ed, func, '['+caption+'] ', force_all)
+        if use_all and r in (RES_FORMATTED, RES_SAME):
+            mark_formatted(ed, func, get_config_stamp(caption, ed.get_filename()))
+
+    def compare(self) -> None:
+        """Run all formatters for current lexer on the document, without applying
+        results, and report their time, memory, changes and idempotence in a new tab."""
+
+        lexer = Helpers.get_editor_lexer()
+        if not lexer:
+            return
+
+        items = helpers.helpers_for_lexer(lexer)
+        if not items:
+            app.msg_status(_('No formatters for "%s"')%lexer)
+            return
+
+        funcs = []
+        errors = []
+        for helper in items:
+            try:
+                func, caption, _f = helpers.get_item_props(helper)
+                funcs.append((caption, func))
+            except Exception as ex:
+                errors.append('%s: %s' % (helper.get('caption', ''), ex))
+
+        text = ed.get_text_all()
+        if not text.strip():
+            return
+
+        fmtconfig.ed_fmt = ed
+        fmtconfig.ed_filename = ed.get_filename()
+        app.msg_status(_('Running {} formatters...').format(len(funcs)), True)
+        results = compare_formatters(funcs, text)
+
+        report = [
+            _('Lexer: {}, document: {} chars, {} lines').format(lexer, len(text), text.count('\n')+1),
+            '',
+            '%-32s %10s %10s %10s %11s  %s' % ('Formatter', 'Sec', 'Peak MB', 'Changed', 'Idempotent', 'Error'),
+            ]
+        for r in results:
+            report.append('%-32s %10.3f %10s %10s %11s  %s' % (
+                r['caption'][:32],
+                r['sec'],
+                '%.1f' % (r['peak']/(1024*1024)) if r['peak'] is not None else '-',
+                r['changed'] if r['changed'] is not None else '-',
+                {True: 'yes', False: 'NO', None: '-'}[r['idempotent']],
+                r['error'].splitlines()[0] if r['error'] else '',
+                ))
+        report += [_('Cannot load: ') + e for e in errors]
+
+        app.file_open('')
+        ed.set_text_all('\n'.join(report) + '\n')
+        app.msg_status(_('Compared {} formatters').format(len(results)))
+
+    def calibrate_apply(self) -> None:
+        """Measure costs of editor API calls in a temporary tab, to choose the
+        cheapest way of applying formatted text; costs are saved for next sessions."""
+
+        app.file_open('')
+        e = app.Editor(ed.get_prop(app.PROP_HANDLE_SELF))
+        app.msg_status(_('Measuring editor speed...'), True)
+        try:
+            costs = calibrate_apply_costs(e)
+        finally:
+            e.set_prop(app.PROP_MODIFIED, False)
+            e.cmd(cmds.cmd_FileClose)
+
+        fmtrun.apply_costs.update(costs)
+        with open(FN_COSTS, 'w', encoding='utf8') as f:
+            json.dump(costs, f, indent=2)
+        app.msg_status(_('Calibrated: replace call {:.1f} µs, line call {:.1f} µs, {:.1f} ns per char').format(
+            costs['replace']*1e6, costs['line']*1e6, costs['char']*1e9))
+
+    def replay_workload(self) -> None:
+        """Replay recorded workload (see option "record_workload"), report
+        time and editor API calls compared with the baseline, in a new tab."""
+
+        records = fmtreplay.load_corpus(DIR_WORKLOAD)
+        if not records:
+            app.msg_status(_('No recorded workload in "%s"') % DIR_WORKLOAD)
+            return
+
+        def get_formatter(key):
+            for helper in helpers.helpers:
+                if helpers.helper_key(helper) == key:
+                    return helpers.get_item_props(helper)[0]
+
+        app.msg_status(_('Replaying recorded workload...'), True)
+        baseline = fmtreplay.load_baseline(DIR_WORKLOAD)
+        results, skipped = fmtreplay.replay(DIR_WORKLOAD, get_formatter)
+
+        report = fmtreplay.describe_corpus(records) + [''] + \
+            fmtreplay.describe_results(results, baseline, skipped)
+        errors = fmtreplay.check_apply()
+        report += ['', _('Check of applying changes: ') + (_('failed') if errors else 'OK')] + errors
+        app.file_open('')
+        ed.set_text_all('\n'.join(report) + '\n')
+        app.msg_status(_('Replayed {} formatting calls').format(len(results)))
+
+        if results and (baseline is None or app.msg_box(
+            _('Save results of this run as the new baseline?'),
+            app.MB_YESNO + app.MB_ICONQUESTION) == app.ID_YES):
+            fmtreplay.save_baseline(DIR_WORKLOAD, results)
+
+    def format_mixed(self) -> None:
+        """Format each sub-lexer block of current file by formatter for its lexer.
+
+        Blocks are found by lexer at line starts, formatted concurrently,
+        and all changes are applied in single undo step. Text of the main
+        lexer is not formatted: its parts between blocks are not complete
+        documents (e.g. unbalanced HTML tags), formatter would break them.
+        """
+        lexer0 = ed.get_prop(app.PROP_LEXER_FILE)
+        if not lexer0:
+            app.msg_status(_('Cannot handle None-lexer'))
+            return
+
+        props = {}  # lexer -> formatter props or None
+        items = []
+        for y1, y2, lexer in get_lexer_regions(ed):
+            if not lexer or lexer == lexer0:
+                continue
+            if lexer not in props:
+                props[lexer] = helpers.get_props_auto(lexer)
+            res = props[lexer]
+            if not res:
+                continue
+            func, caption, force_all = res
+            # formatter needs entire text, it cannot format a fragment
+            if force_all:
+                continue
+            items.append((y1, y2, func))
+
+        if not items:
+            app.msg_status(_('No formatters for sub-lexer blocks of "%s"') % lexer0)
+            return
+
+        used = [lexer for lexer in props if props[lexer]]
+        run_format_regions(ed, items, '['+', '.join(used)+'] ')
+
+    def format_all_tabs(self) -> None:
+        """Format all opened files by their on_save formatters.
+
+        Files are grouped by formatter (and folder, for local configs), and
+        each group is formatted by single call of formatter's batch function.
+        """
+        groups = {}  # (caption, folder) -> (props, list of (editor, text))
+        for h in app.ed_handles():
+            e = app.Editor(h)
+            lexer = helpers.get_auto_lexer(e)
+            if not lexer:
+                continue
+            res = helpers.get_props_on_save(lexer, e)
+            if not res:
+                continue
+            text = e.get_text_all()
+            if not text.strip():
+                continue
+            key = (res[1], os.path.dirname(e.get_filename()))
+            groups.setdefault(key, (res, []))[1].append((e, text))
+
+        if not groups:
+            app.msg_status(_('No opened files with on_save formatters'))
+            return
+
+        count = 0
+        for (caption, folder), ((func, _c, _f), items) in groups.items():
+            # local config is found by the first file of the group
+            fmtconfig.ed_fmt = items[0][0]
+            fmtconfig.ed_filename = items[0][0].get_filename()
+            texts1 = [text for (e, text) in items]
+            try:
+                texts = format_batch(func, texts1)
+            except Exception as ex:
+                app.msg_box(_('Formatter gave exception:') + '\n\n' + str(ex), app.MB_OK + app.MB_ICONERROR)
+                continue
+            for (e, text1), text in zip(items, texts):
+                if text and text != text1:
+                    replace_all_preserving_linestates(e, text1, text)
+                    count += 1
+
+        app.msg_status(_('Formatted {} opened files').format(count))
 
     def on_save_pre(self, ed_self: Any) -> None:
         """Event handler: auto-format before save if configured.
@@ -419,16 +1332,238 @@ class Command:
             ed_self: Editor instance
         """
 
-        lexer = ed_self.get_prop(app.PROP_LEXER_FILE)
+        budget_ms = options.get('on_save_budget_ms', 0)
+        budget = budget_ms / 1000 if budget_ms else None
+
+        lexer = helpers.get_auto_lexer(ed_self, bool(budget))
         if not lexer:
             return
 
+        # text is not changed since formatting: skip it, without reading the text
         res = helpers.get_props_on_save(lexer)
+        if not res:
+            return
+        filename = ed_self.get_filename()
+        if is_formatted(ed_self, res[0], get_config_stamp(res[1], filename)):
+            return
+
+        res = helpers.get_props_on_save(lexer, ed_self)
         if not res: # None or False
             return
 
-        func, caption, _ = res
-        run_format(ed_self, func, '['+caption+'] ', True)
+        func, caption, _f = res
+        msg = '['+caption+'] '
+
+        r = run_format(ed_self, func, msg, True, budget)
+        if r in (RES_FORMATTED, RES_SAME):
+            mark_formatted(ed_self, func, get_config_stamp(caption, filename))
+        elif r == RES_OVER_BUDGET:
+            if options.get('on_save_over_budget') == 'defer':
+                self.deferred.add(ed_self.get_prop(app.PROP_HANDLE_SELF))
+                app.msg_status(msg + _('Formatting is deferred until after save, it exceeds on_save time budget'))
+            else:
+                app.msg_status(msg + _('Formatting is skipped, it exceeds on_save time budget'))
+
+    def on_save(self, ed_self: Any) -> None:
+        """Event handler: run formatting which was deferred by on_save_pre.
+
+        Args:
+            ed_self: Editor instance
+        """
+        h = ed_self.get_prop(app.PROP_HANDLE_SELF)
+        if h in self.deferred:
+            # let the editor finish saving, then format
+            app.timer_proc(app.TIMER_START_ONE, self.format_deferred, 100)
+
+        # formatter config is changed: formatter objects and background results may be outdated
+        fn = os.path.basename(ed_self.get_filename())
+        items = [item for item in helpers.helpers if item.get('config') == fn]
+        if items:
+            helpers.invalidate(items)
+            clear_precomputed()
+            clear_format_states()
+
+    def on_close(self, ed_self: Any) -> None:
+        """Event handler: forget state of closed editor.
+
+        Args:
+            ed_self: Editor instance
+        """
+        h = ed_self.get_prop(app.PROP_HANDLE_SELF)
+        format_states.pop(h, None)
+        lexer_pos_cache.pop(h, None)
+        self.typed_known.pop(h, None)
+
+    def on_open(self, ed_self: Any) -> None:
+        """Event handler: start background formatting, if configured.
+
+        Args:
+            ed_self: Editor instance
+        """
+        if options.get('speculative'):
+            self.speculate(ed_self)
+
+    def speculate(self, ed_self: Any) -> None:
+        """Format document in the background by its default formatter,
+        so Format command or saving can use the ready result.
+
+        Args:
+            ed_self: Editor instance
+        """
+        lexer = helpers.get_file_lexer(ed_self)
+        if not lexer:
+            return
+        res = helpers.get_props_auto(lexer, ed_self)
+        if not res:
+            return
+        func, caption, _f = res
+        if not func.threads:
+            # formatter is not declared thread-safe, it's not called in the background
+            return
+
+        text = ed_self.get_text_all()
+        if not text.strip() or len(text) > options.get('speculative_max_kb', 4096) * 1024:
+            return
+        filename = ed_self.get_filename()
+        if get_precomputed(func, text, False, filename) is not None:
+            return
+
+        h = ed_self.get_prop(app.PROP_HANDLE_SELF)
+        job = self.spec_jobs.pop(h, None)
+        if job:
+            job[4].cancel()
+
+        # job runs later in worker thread: pass the file for its config
+        future = bg_executor.submit(fmtconfig.run_for_file, filename, func, text)
+        self.spec_jobs[h] = (text, filename, func, caption, future)
+        app.timer_proc(app.TIMER_START, self.on_spec_poll, 200)
+
+    def on_spec_poll(self, tag: str = '', info: str = '') -> None:
+        """Timer callback: keep results of finished background formatting."""
+
+        h_current = ed.get_prop(app.PROP_HANDLE_SELF)
+        for h, (text, filename, func, caption, future) in list(self.spec_jobs.items()):
+            if not future.done():
+                continue
+            del self.spec_jobs[h]
+            if future.cancelled() or future.exception():
+                continue
+
+            res = future.result()
+            if not res and not isinstance(res, list):
+                continue
+            put_precomputed(func, text, res, filename)
+
+            needed = bool(res) if isinstance(res, list) else res != text
+            if needed and h == h_current:
+                app.msg_status('['+caption+'] ' + _('Text needs formatting'))
+
+        if not self.spec_jobs:
+            app.timer_proc(app.TIMER_STOP, self.on_spec_poll, 0)
+
+    def format_deferred(self, tag: str = '', info: str = '') -> None:
+        """Timer callback: format editors which were saved with deferred formatting."""
+
+        handles = self.deferred
+        self.deferred = set()
+
+        for h in handles:
+            e = app.Editor(h)
+            lexer = helpers.get_auto_lexer(e)
+            if not lexer:
+                continue
+            res = helpers.get_props_on_save(lexer)
+            if not res:
+                continue
+            func, caption, _f = res
+            if run_format(e, func, '['+caption+'] ', True) == RES_FORMATTED:
+                app.msg_status('['+caption+'] ' + _('Formatted after save; save again to keep the changes'))
+
+    def on_exit(self, ed_self: Any) -> None:
+        """Event handler: save measured speed, close formatter objects and daemons."""
+        self.save_speed()
+        helpers.teardown(helpers.helpers)
+        fmtdaemon.shutdown()
+
+    def on_change_slow(self, ed_self: Any) -> None:
+        """Event handler: schedule formatting of edited lines and background
+        formatting, if configured.
+
+        Args:
+            ed_self: Editor instance
+        """
+        if options.get('speculative'):
+            self.speculate(ed_self)
+
+        if not any(h.get('on_type') for h in helpers.helpers):
+            return
+
+        h = ed_self.get_prop(app.PROP_HANDLE_SELF)
+        # more typing arrived: result of running job is outdated
+        job = self.typed_jobs.pop(h, None)
+        if job:
+            job[2].cancel()
+
+        self.typed.add(h)
+        # restarting the timer gives the debounce
+        app.timer_proc(app.TIMER_START_ONE, self.on_type_timer, options.get('on_type_delay_ms', 1000))
+
+    def on_type_timer(self, tag: str = '', info: str = '') -> None:
+        """Timer callback: start background formatting of edited lines."""
+
+        handles = self.typed
+        self.typed = set()
+
+        for h in handles:
+            e = app.Editor(h)
+            lexer = e.get_prop(app.PROP_LEXER_FILE)
+            if not lexer:
+                continue
+            res = helpers.get_props_on_type(lexer)
+            if not res:
+                continue
+            func = res[0]
+
+            known = self.typed_known.setdefault(h, set())
+            blocks = get_line_blocks(e, get_changed_ranges(e))
+            blocks = [b for b in blocks if b[2] not in known]
+            if not blocks:
+                continue
+
+            version = e.get_prop(app.PROP_MODIFIED_VERSION)
+            # job runs later in worker thread: pass the file for its config
+            future = bg_executor.submit(fmtconfig.run_for_file, e.get_filename(), format_blocks, func, blocks)
+            self.typed_jobs[h] = (version, blocks, future)
+
+        if self.typed_jobs:
+            app.timer_proc(app.TIMER_START, self.on_type_poll, 50)
+
+    def on_type_poll(self, tag: str = '', info: str = '') -> None:
+        """Timer callback: apply finished background formatting of edited lines."""
+
+        for h, (version, blocks, future) in list(self.typed_jobs.items()):
+            if not future.done():
+                continue
+            del self.typed_jobs[h]
+            if future.cancelled():
+                continue
+
+            e = app.Editor(h)
+            # text was changed while formatter worked: discard the result
+            if e.get_prop(app.PROP_MODIFIED_VERSION) != version:
+                continue
+
+            results = future.result()
+            apply_blocks(e, blocks, results)
+
+            known = self.typed_known.setdefault(h, set())
+            if len(known) > MAX_TYPED_KNOWN:
+                known.clear()
+            for (y1, y2, text), new_text in zip(blocks, results):
+                known.add(text if new_text is None else new_text)
+
+        if not self.typed_jobs:
+            app.timer_proc(app.TIMER_STOP, self.on_type_poll, 0)
 
     def config(self, is_global: bool) -> None:
         """Open formatter configuration (global or local).
@@ -718,24 +1853,39 @@ class Command:
 
         Enables/disables automatic formatting when file is saved.
         """
+        self.config_flag_ex('on_save')
+
+    def config_label_type(self) -> None:
+        """Configure on_type auto-formatting for formatters.
+
+        Enables/disables formatting of edited lines, after a pause in typing.
+        """
+        self.config_flag_ex('on_type')
+
+    def config_flag_ex(self, key: str) -> None:
+        """Toggle boolean flag of formatters (internal helper).
+
+        Args:
+            key: Flag name, used both as helper key and config key (e.g., 'on_save')
+        """
         while True:
             caps = [
                 item.get('caption', 'Unknown') +
-                (' -- on_save' if item.get('on_save') else '') +
+                (' -- ' + key if item.get(key) else '') +
                 '\t' + item.get('lexers', '')
                 for item in helpers.helpers
             ]
-            res = app.dlg_menu(app.DMENU_LIST, caps, caption=_('Formatters label "on_save"'))
+            res = app.dlg_menu(app.DMENU_LIST, caps, caption=_('Formatters label "%s"') % key)
             if res is None:
                 return
 
             helper = helpers.helpers[res]
-            helper['on_save'] = not helper.get('on_save', False)
+            helper[key] = not helper.get(key, False)
 
             # Save to config using helper method
             helper_caption = helper.get('caption', 'unknown')
-            value = True if helper.get('on_save') else None
-            self._save_label_to_config('on_save', helper_caption, value)
+            value = True if helper.get(key) else None
+            self._save_label_to_config(key, helper_caption, value)
 
     def format_label(self, label: str) -> None:
         """Format using formatter with given per-lexer label (A/B/C/D).
@@ -744,6 +1894,9 @@ class Command:
             label: Label character to search for
         """
 
+        if self.format_carets(label):
+            return
+
         lexer = Helpers.get_editor_lexer()
         if not lexer:
             return
@@ -755,7 +1908,10 @@ class Command:
 
         for helper in items:
             if helper.get('label') == label:
-                func, caption, force_all = helpers.get_item_props(helper)
+                routed = helpers.route_by_size(lexer, [helper], ed)
+                if not routed:
+                    return
+                func, caption, force_all = helpers.get_item_props(routed[0])
                 run_format(
                     ed,
                     func,
@@ -773,10 +1929,7 @@ class Command:
             label: Label character to search for
         """
 
-        if len(ed.get_carets()) > 1:
-            app.msg_status(_('Cannot handle multi-carets yet'))
-            return
-
+        # formatter doesn't depend on lexer, so run_format handles multi-selections
         for helper in helpers.helpers:
             if helper.get('label_x') == label:
                 func, caption, force_all = helpers.get_item_props(helper)
@@ -834,7 +1987,7 @@ class Command:
             if helper.get('minifier'):
                 func, caption, force_all = helpers.get_item_props(helper)
                 text0 = ed.get_text_all()
-                text = func(text0)
+                text = as_text(text0, func(text0))
                 is_same = text == text0
                 del text0
                 if is_same:
@@ -1,5 +1,8 @@
 import os
+import json
 import shutil
+import threading
+import configparser
 from cudatext import *
 
 from cudax_lib import get_translation
@@ -8,6 +11,25 @@ _   = get_translation(__file__)  # i18n
 ed_fmt = ed
 ed_filename = ''
 
+# file being formatted by background job of this thread, see run_for_file()
+_thread_file = threading.local()
+
+
+def current_editor_filename():
+    """Get file being formatted: from run_for_file() in worker thread, else ed_filename."""
+    return getattr(_thread_file, 'filename', ed_filename)
+
+
+def run_for_file(filename, func, *args):
+    """Call func(*args) in this thread (usually a worker thread), so configs are
+    resolved for given filename, even if main thread formats other file meanwhile."""
+    _thread_file.filename = filename
+    try:
+        return func(*args)
+    finally:
+        del _thread_file.filename
+
+
 class FmtConfig:
     def __init__(self, fn, dir):
         self.fn = fn
@@ -19,14 +41,16 @@ class FmtConfig:
             shutil.copyfile(ini0, ini)
         self.ini_global = ini
 
-    def ini_local(self):
-        if ed_filename:
-            return os.path.join(os.path.dirname(ed_filename), self.fn)
+    def ini_local(self, filename=None):
+        if filename is None:
+            filename = current_editor_filename()
+        if filename:
+            return os.path.join(os.path.dirname(filename), self.fn)
         else:
             return ''
 
-    def current_filename(self):
-        ini = self.ini_local()
+    def current_filename(self, filename=None):
+        ini = self.ini_local(filename)
         if os.path.isfile(ini):
             return ini
         else:
@@ -62,3 +86,66 @@ class FmtConfig:
                 file_open(ini)
             else:
                 msg_box(_('Cannot copy global config file "%s" to local folder') % self.fn, MB_OK)
+
+
+def parse_json(fn):
+    with open(fn, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def parse_ini(fn):
+    cfg = configparser.ConfigParser()
+    cfg.read(fn, encoding='utf-8')
+    return cfg
+
+def parse_text(fn):
+    with open(fn, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def default_parser(fn):
+    """Choose parser by config file extension."""
+    ext = os.path.splitext(fn)[1].lower()
+    if ext == '.json':
+        return parse_json
+    if ext in ('.ini', '.cfg', '.conf'):
+        return parse_ini
+    return parse_text
+
+
+class ConfigCache:
+    """Parsed config files, cached by resolved path and invalidated by mtime/size.
+
+    Parsed objects are shared between callers, so they must not be modified.
+    """
+    def __init__(self):
+        self.items = {}
+
+    def get(self, fn, parser=None):
+        if not fn:
+            return None
+        fn = os.path.realpath(fn)
+        try:
+            st = os.stat(fn)
+        except OSError:
+            self.items.pop(fn, None)
+            return None
+
+        if parser is None:
+            parser = default_parser(fn)
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        item = self.items.get(fn)
+        # bound methods are new objects on each access, so compare them by value
+        if item and item[0] == stamp and item[1] == parser:
+            return item[2]
+
+        data = parser(fn)
+        self.items[fn] = (stamp, parser, data)
+        return data
+
+    def invalidate(self, fn=None):
+        if fn is None:
+            self.items.clear()
+        else:
+            self.items.pop(os.path.realpath(fn), None)
+
+config_cache = ConfigCache()
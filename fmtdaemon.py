@@ -0,0 +1,196 @@
+"""Pool of long-lived formatter processes (daemons) for 2nd-level formatters.
+
+Formatter which runs external tool can keep it running, to not pay the
+process startup on each call:
+
+    from cuda_fmt import fmtdaemon
+    def do_format(text):
+        return fmtdaemon.request(['node', SERVER_JS], text, indent=4)
+
+Protocol is JSON lines over stdin/stdout of the daemon. For each request,
+daemon reads one line:
+    {"text": "...", <other params>}
+and writes one line:
+    {"text": "..."}  or  {"error": "message"}
+
+Daemons are reused across calls (and editor tabs), restarted if they crash,
+and closed when they are idle for some time.
+Module doesn't depend on CudaText API, so it can be tested with a plain
+Python script as the daemon.
+"""
+
+import json
+import time
+import queue
+import atexit
+import threading
+import subprocess
+
+IDLE_TIMEOUT = 300     # seconds; idle daemon is closed after it
+IDLE_CHECK = 10        # seconds; how often idle daemons are checked
+MAX_PER_COMMAND = 2    # max count of idle daemons kept for one command
+
+
+class DaemonError(Exception):
+    pass
+
+
+class DaemonTimeout(DaemonError):
+    pass
+
+
+class Daemon:
+    """One running daemon process."""
+
+    def __init__(self, command, cwd=None):
+        self.command = command
+        self.last_used = time.monotonic()
+        try:
+            self.proc = subprocess.Popen(
+                command,
+                cwd=cwd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                encoding='utf-8',
+                bufsize=1,
+                creationflags=getattr(subprocess, 'CREATE_NO_WINDOW', 0),
+                )
+        except OSError as e:
+            raise DaemonError('Cannot start daemon: ' + str(e))
+        # reader thread allows timeout on reading, also on Windows pipes
+        self.lines = queue.Queue()
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put(line)
+        self.lines.put(None)  # EOF: process is finished
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def call(self, req, timeout):
+        """Send request dict, return response dict."""
+        try:
+            self.proc.stdin.write(json.dumps(req) + '\n')
+            self.proc.stdin.flush()
+        except (OSError, ValueError) as e:
+            raise DaemonError('Cannot write to daemon: ' + str(e))
+
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            raise DaemonTimeout('Daemon did not answer in %d seconds' % timeout)
+        if line is None:
+            raise DaemonError('Daemon is finished, exit code %s' % self.proc.poll())
+
+        self.last_used = time.monotonic()
+        try:
+            return json.loads(line)
+        except ValueError:
+            raise DaemonError('Daemon gave not JSON answer: ' + line[:200])
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(1)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+
+class DaemonPool:
+    """Idle daemons, grouped by command and working dir."""
+
+    def __init__(self):
+        self.idle = {}  # (command, cwd) -> list of Daemon
+        self.lock = threading.Lock()
+        self.sweeper = None
+
+    def acquire(self, key):
+        with self.lock:
+            items = self.idle.get(key, [])
+            while items:
+                d = items.pop()
+                if d.alive():
+                    return d
+                d.close()
+        d = Daemon(list(key[0]), key[1])
+        self._start_sweeper()
+        return d
+
+    def release(self, key, d):
+        with self.lock:
+            items = self.idle.setdefault(key, [])
+            if len(items) < MAX_PER_COMMAND:
+                items.append(d)
+                return
+        d.close()
+
+    def close_idle(self, max_idle):
+        now = time.monotonic()
+        closing = []
+        with self.lock:
+            for key, items in self.idle.items():
+                keep = [d for d in items if now - d.last_used < max_idle and d.alive()]
+                closing += [d for d in items if d not in keep]
+                items[:] = keep
+        for d in closing:
+            d.close()
+
+    def close_all(self):
+        self.close_idle(-1)
+
+    def _start_sweeper(self):
+        if self.sweeper:
+            return
+        def sweep():
+            while True:
+                time.sleep(IDLE_CHECK)
+                self.close_idle(IDLE_TIMEOUT)
+        self.sweeper = threading.Thread(target=sweep, daemon=True)
+        self.sweeper.start()
+
+
+pool = DaemonPool()
+atexit.register(pool.close_all)
+
+
+def request(command, text, cwd=None, timeout=30, **params):
+    """Format text by daemon started with given command (list of args).
+
+    Crashed daemon is restarted once. Raises DaemonError if daemon fails,
+    or if it returns the error.
+    """
+    key = (tuple(command), cwd)
+    req = dict(params, text=text)
+
+    for attempt in (1, 2):
+        d = pool.acquire(key)
+        try:
+            resp = d.call(req, timeout)
+        except DaemonTimeout:
+            d.close()
+            raise
+        except DaemonError:
+            d.close()
+            # daemon crashed (maybe on the previous call): start new one
+            if attempt == 2:
+                raise
+            continue
+        pool.release(key, d)
+        break
+
+    if 'error' in resp:
+        raise DaemonError(resp['error'])
+    return resp.get('text', '')
+
+
+def shutdown():
+    """Close all idle daemons."""
+    pool.close_all()
@@ -0,0 +1,375 @@
+"""Recording of the real formatting workload, and its replay for performance
+regression testing.
+
+Recorder is called from run_format (see fmtrun.record_workload), it appends
+anonymized descriptors of formatting calls (lexer, formatter, sizes, line
+counts, count of selections, timings; no file names) to corpus file:
+    <corpus dir>/corpus.jsonl
+Optionally it also saves input/output texts, as files named by text hash:
+    <corpus dir>/texts/<sha1>.txt
+
+Replay runs recorded entire-text formatting calls (which have saved texts)
+through run_format on SimEditor, the editor model which counts API calls.
+Results are compared with the stored baseline (results of previous version):
+    <corpus dir>/baseline.json
+"""
+
+import os
+import json
+import time
+from collections import Counter, OrderedDict
+from cudatext import *
+from . import fmtrun, fmtconfig
+
+CORPUS_FILE = 'corpus.jsonl'
+BASELINE_FILE = 'baseline.json'
+TEXTS_DIR = 'texts'
+MAX_TEXT_SIZE = 4*1024*1024  # bigger texts are not saved, only descriptors
+
+
+class Recorder:
+    """Writer of workload corpus."""
+
+    def __init__(self, dirname, with_texts=False):
+        self.dirname = dirname
+        self.with_texts = with_texts
+
+    def save_text(self, text):
+        """Save text to corpus (once), return its hash."""
+        h = fmtrun.text_hash(text)
+        fn = os.path.join(self.dirname, TEXTS_DIR, h+'.txt')
+        if not os.path.isfile(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, 'w', encoding='utf-8', newline='', errors='surrogatepass') as f:
+                f.write(text)
+        return h
+
+    def record(self, info, old=None, new=None):
+        info = dict(info, time=int(time.time()))
+        if self.with_texts and isinstance(old, str) and len(old) <= MAX_TEXT_SIZE:
+            info['old'] = self.save_text(old)
+            if isinstance(new, str) and len(new) <= MAX_TEXT_SIZE:
+                info['new'] = self.save_text(new)
+
+        os.makedirs(self.dirname, exist_ok=True)
+        with open(os.path.join(self.dirname, CORPUS_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(info) + '\n')
+
+
+def counted(method):
+    """Decorator of SimEditor methods, to count calls of editor API."""
+    def wrapper(self, *args, **kwargs):
+        self.calls[method.__name__] += 1
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+
+class SimEditor:
+    """Model of CudaText editor, enough for run_format: text is list of lines,
+    calls of API methods are counted in self.calls."""
+
+    def __init__(self, text, lexer=''):
+        self.lines = text.split('\n')
+        self.lexer = lexer
+        self.caret = (0, 0)
+        self.version = 0
+        self.calls = Counter()
+
+    def text(self):
+        return '\n'.join(self.lines)
+
+    def _pos(self, x, y):
+        # positions after the end are clipped, like editor does
+        if y >= len(self.lines):
+            y = len(self.lines)-1
+            x = len(self.lines[y])
+        return min(x, len(self.lines[y])), y
+
+    @counted
+    def get_sel_mode(self):
+        return SEL_NORMAL
+
+    @counted
+    def get_filename(self, *args):
+        return ''
+
+    @counted
+    def get_carets(self):
+        x, y = self.caret
+        return [(x, y, -1, -1)]
+
+    @counted
+    def set_caret(self, x, y, *args, **kwargs):
+        self.caret = (x, y)
+
+    @counted
+    def action(self, *args):
+        pass
+
+    @counted
+    def get_prop(self, prop, value=''):
+        if prop == PROP_LINE_STATES:
+            return [0]*len(self.lines)
+        if prop == PROP_LEXER_FILE:
+            return self.lexer
+        if prop == PROP_MODIFIED_VERSION:
+            return self.version
+        if prop == PROP_HANDLE_SELF:
+            return id(self)
+
+    @counted
+    def set_prop(self, prop, value):
+        pass
+
+    @counted
+    def get_text_all(self):
+        return self.text()
+
+    @counted
+    def get_line_count(self):
+        return len(self.lines)
+
+    @counted
+    def get_text_line(self, y, *args):
+        if 0 <= y < len(self.lines):
+            return self.lines[y]
+
+    @counted
+    def get_line_len(self, y):
+        return len(self.lines[y])
+
+    @counted
+    def get_text_substr(self, x1, y1, x2, y2):
+        x1, y1 = self._pos(x1, y1)
+        x2, y2 = self._pos(x2, y2)
+        if y1 == y2:
+            return self.lines[y1][x1:x2]
+        return '\n'.join([self.lines[y1][x1:]] + self.lines[y1+1:y2] + [self.lines[y2][:x2]])
+
+    def _replace(self, x1, y1, x2, y2, text):
+        x1, y1 = self._pos(x1, y1)
+        x2, y2 = self._pos(x2, y2)
+        tail = self.lines[y2][x2:]
+        new = (self.lines[y1][:x1] + text + tail).split('\n')
+        self.lines[y1:y2+1] = new
+        self.version += 1
+        # position after the inserted text
+        return (len(new[-1]) - len(tail), y1 + len(new) - 1)
+
+    @counted
+    def replace(self, x1, y1, x2, y2, text):
+        return self._replace(x1, y1, x2, y2, text)
+
+    @counted
+    def insert(self, x, y, text):
+        return self._replace(x, y, x, y, text)
+
+    @counted
+    def delete(self, x1, y1, x2, y2):
+        self._replace(x1, y1, x2, y2, '')
+
+    @counted
+    def set_text_line(self, y, text):
+        if y == -1:
+            self.lines.append(text)
+        else:
+            self.lines[y] = text
+        self.version += 1
+
+
+# (old text, new text) which were applied wrongly before: line separators
+# other than EOL, change of the ending EOL, long lines
+APPLY_CHECKS = [
+    ('a = 1\nx\fy\nb=2\n', 'a = 1\nx\fy\nb = 2\n'),
+    ('a\fb\nc\n', 'a\fb\nc\nd\n'),
+    ('p\u2028q\nr\n', 'p\u2028q\nr2\n'),
+    ('a\x85b\nc', 'a\x85b\nc\nd'),
+    ('x\x0b\ny\x1c\n', 'x\x0b\nz\ny\x1c\n'),
+    ('a\nb\n', 'a\nb'),
+    ('x'*1500 + '\f1\nz\n', 'x'*1500 + '\f2\nz\n'),
+    ]
+
+
+def check_apply():
+    """Regression check of replace_all_preserving_linestates: each strategy
+    must give exactly the new text on SimEditor. Returns list of errors."""
+    errors = []
+    for old, new in APPLY_CHECKS:
+        same_eol = old.endswith('\n') == new.endswith('\n')
+        same_count = old.count('\n') == new.count('\n')
+        for strategy in ('full', 'hunks', 'lines'):
+            if strategy != 'full' and not same_eol:
+                continue
+            if strategy == 'lines' and not same_count:
+                continue
+            sim = SimEditor(old)
+            fmtrun.replace_all_preserving_linestates(sim, old, new, strategy)
+            if sim.text() != new:
+                errors.append('%s: %r -> %r gave %r' % (strategy, old[-40:], new[-40:], sim.text()[-40:]))
+        sim = SimEditor(old)
+        strategy = fmtrun.replace_all_preserving_linestates(sim, old, new)
+        if sim.text() != new:
+            errors.append('%s (chosen): %r -> %r gave %r' % (strategy, old[-40:], new[-40:], sim.text()[-40:]))
+    return errors
+
+
+def load_corpus(dirname):
+    """Get list of recorded descriptors."""
+    res = []
+    fn = os.path.join(dirname, CORPUS_FILE)
+    if not os.path.isfile(fn):
+        return res
+    with open(fn, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                res.append(json.loads(line))
+            except ValueError:
+                pass
+    return res
+
+
+def load_text(dirname, h):
+    fn = os.path.join(dirname, TEXTS_DIR, h+'.txt')
+    if not os.path.isfile(fn):
+        return None
+    with open(fn, 'r', encoding='utf-8', newline='', errors='surrogatepass') as f:
+        return f.read()
+
+
+def load_baseline(dirname):
+    fn = os.path.join(dirname, BASELINE_FILE)
+    if not os.path.isfile(fn):
+        return None
+    with open(fn, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(dirname, results):
+    with open(os.path.join(dirname, BASELINE_FILE), 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+
+def replay(dirname, get_formatter):
+    """Replay recorded entire-text formatting calls, which have saved texts.
+
+    get_formatter: function formatter key -> formatter, or None if formatter
+    is not installed now.
+    Returns (results, skipped): results is dict id -> dict of measurements
+    (sec, calls, result, output hash), skipped is count of not replayed records.
+    """
+    results = {}
+    skipped = 0
+    # replay must not change state of the session: don't record it, don't use
+    # results of background formatting, don't change measured speed
+    saved_recorder = fmtrun.recorder
+    saved_speed = dict(fmtrun.speed_stats)
+    saved_precomputed = OrderedDict(fmtrun.precomputed)
+    saved_ed = (fmtconfig.ed_fmt, fmtconfig.ed_filename)
+    fmtrun.recorder = None
+    fmtrun.precomputed.clear()
+    try:
+        for rec in load_corpus(dirname):
+            if rec.get('mode') != 'all' or not rec.get('old'):
+                continue
+            rec_id = rec['formatter'] + ':' + rec['old']
+            if rec_id in results:
+                continue
+            text = load_text(dirname, rec['old'])
+            func = get_formatter(rec['formatter'])
+            if text is None or func is None:
+                skipped += 1
+                continue
+
+            sim = SimEditor(text, rec.get('lexer', ''))
+            t0 = time.perf_counter()
+            res = fmtrun.run_format(sim, func, '', True)
+            sec = time.perf_counter()-t0
+            results[rec_id] = {
+                'size': len(text),
+                'sec': sec,
+                'calls': sum(sim.calls.values()),
+                'result': res,
+                'output': fmtrun.text_hash(sim.text()),
+                }
+    finally:
+        fmtrun.recorder = saved_recorder
+        # dicts are changed in place, other modules keep references to them
+        fmtrun.speed_stats.clear()
+        fmtrun.speed_stats.update(saved_speed)
+        fmtrun.precomputed.clear()
+        fmtrun.precomputed.update(saved_precomputed)
+        fmtconfig.ed_fmt, fmtconfig.ed_filename = saved_ed
+    return results, skipped
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+def describe_corpus(records):
+    """Get report lines about recorded workload."""
+    res = ['Recorded calls: %d' % len(records)]
+    if not records:
+        return res
+
+    modes = Counter(r.get('mode', '') for r in records)
+    res.append('By mode: ' + ', '.join('%s: %d' % m for m in modes.most_common()))
+    lexers = Counter(r.get('lexer', '') or '-' for r in records)
+    res.append('By lexer: ' + ', '.join('%s: %d' % m for m in lexers.most_common(10)))
+
+    sizes = [r['size'] for r in records if 'size' in r]
+    if sizes:
+        res.append('Size, chars: median %d, 90%% %d, max %d' % (
+            percentile(sizes, 0.5), percentile(sizes, 0.9), max(sizes)))
+
+    full = [r for r in records if r.get('mode') == 'all' and 'new_lines' in r]
+    if full:
+        changed = sum(1 for r in full if r['new_lines'] != r['lines'])
+        res.append('Line count changed: %d of %d formatted texts' % (changed, len(full)))
+
+    sels = [r['sels'] for r in records if r.get('mode') == 'sel']
+    if sels:
+        res.append('Selections per call: median %d, max %d' % (percentile(sels, 0.5), max(sels)))
+    return res
+
+
+def describe_results(results, baseline, skipped):
+    """Get report lines about replay results, compared with baseline."""
+    res = ['Replayed: %d, skipped (no texts or formatter): %d' % (len(results), skipped)]
+    if not baseline:
+        res.append('No baseline, this run is saved as baseline')
+        baseline = {}
+
+    res.append('')
+    res.append('%-48s %10s %10s %8s %8s %8s  %s' % (
+        'Formatter:text', 'Size', 'Sec', 'dSec%', 'Calls', 'dCalls', 'Output'))
+
+    total_sec = total_base_sec = 0
+    total_calls = total_base_calls = 0
+    for rec_id, r in sorted(results.items()):
+        base = baseline.get(rec_id)
+        if base:
+            dsec = '%+.0f' % ((r['sec']-base['sec']) / base['sec'] * 100) if base['sec'] else '-'
+            dcalls = '%+d' % (r['calls']-base['calls'])
+            output = 'same' if r['output'] == base['output'] else 'CHANGED'
+            total_sec += r['sec']
+            total_base_sec += base['sec']
+            total_calls += r['calls']
+            total_base_calls += base['calls']
+        else:
+            dsec = dcalls = '-'
+            output = 'new'
+        name = rec_id if len(rec_id) <= 48 else rec_id[:36] + '..' + rec_id[-10:]
+        res.append('%-48s %10d %10.3f %8s %8d %8s  %s' % (
+            name, r['size'], r['sec'], dsec, r['calls'], dcalls, output))
+
+    if total_base_sec:
+        res.append('')
+        res.append('Total vs baseline: time %+.1f%%, editor calls %+d' % (
+            (total_sec-total_base_sec) / total_base_sec * 100,
+            total_calls-total_base_calls))
+    return res
@@ -1,10 +1,750 @@
+import os
+import re
+import time
 import difflib
+import hashlib
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cudatext import *
 from . import fmtconfig
 
 from cudax_lib import get_translation
 _   = get_translation(__file__)  # i18n
 
+# results of run_format
+RES_NONE = 0         # nothing done: error, empty text, not formatted
+RES_FORMATTED = 1    # text was changed
+RES_SAME = 2         # text is already formatted
+RES_OVER_BUDGET = 3  # skipped, predicted time exceeds the budget
+
+# measured speed of formatters: key -> seconds per char (moving average)
+speed_stats = {}
+SPEED_MIN_SIZE = 1000  # don't measure on tiny texts, startup time dominates there
+SPEED_AVERAGE = 0.3
+
+
+def formatter_key(func):
+    """Stable key of formatter function, to keep statistics for it."""
+    key = getattr(func, 'key', None)
+    if key:
+        return key
+    return getattr(func, '__module__', '') + '.' + getattr(func, '__qualname__', repr(func))
+
+
+class Formatter:
+    """Formatter of 2nd-level plugin, with optional features declared in its install.inf.
+
+    Object is called like usual formatter function: text -> text, so it can be
+    passed anywhere the plain function is expected.
+
+    Options:
+        stream: function takes and returns iterables of lines (without EOLs),
+            it's declared by "stream=1"
+        batch: function which takes list of texts and returns list of results,
+            it's declared by "method_batch=name"
+        chunks: rule to split big text to chunks which are formatted independently,
+            it's declared by "chunks=rule", see split_chunks()
+        instance: object of formatter class, which is created once and keeps
+            the state between calls, it's declared by "class=name"
+        speed: speed class, used to predict time until the speed is measured,
+            it's declared by "speed=fast|normal|slow"
+        threads: function can run in several threads at once, and in the
+            background thread, it's declared by "threads=1"
+    """
+    def __init__(self, func, key='', stream=False, batch=None, chunks='', instance=None, speed='', threads=False):
+        self.func = func
+        self.key = key or formatter_key(func)
+        self.stream = stream
+        self.batch = batch
+        self.chunks = chunks
+        self.instance = instance
+        self.speed = speed
+        self.threads = threads
+
+    def invalidate(self):
+        """Tell formatter object that its config is changed."""
+        method = getattr(self.instance, 'invalidate', None)
+        if method:
+            method()
+
+    def close(self):
+        """Tell formatter object that it's unloaded."""
+        method = getattr(self.instance, 'close', None)
+        if method:
+            method()
+
+    def __call__(self, text):
+        if self.stream:
+            return '\n'.join(self.func(iter(text.split('\n'))))
+        return self.func(text)
+
+    def format_batch(self, texts):
+        """Format list of texts, returns list of results."""
+        if self.batch and texts:
+            res = list(self.batch(list(texts)))
+            if len(res) != len(texts):
+                raise ValueError('Batch formatter returned %d results for %d texts' % (len(res), len(texts)))
+            return res
+        return [self(text) for text in texts]
+
+    def format_lines(self, lines):
+        """Format iterable of lines (without EOLs), returns iterable of lines."""
+        if self.stream:
+            return self.func(lines)
+        return self.func('\n'.join(lines)).split('\n')
+
+
+class Pipeline:
+    """Several formatters called in a row; text is passed between them in memory,
+    so only the final result is applied to the editor."""
+    def __init__(self, funcs):
+        self.funcs = funcs
+
+    def __call__(self, text):
+        for func in self.funcs:
+            res = as_text(text, func(text))
+            if not res:
+                # step failed, whole pipeline fails
+                return res
+            text = res
+        return text
+
+
+def normalize_edits(edits, line_count):
+    """Check line edits returned by formatter, and convert them to the form
+    (y_from, y_to_excluding, list_of_lines), sorted by position.
+
+    Formatter returns edits as list of ((y_from, y_to_excluding), replacement),
+    where replacement is list of lines (without EOLs), or string which is
+    split to lines by EOL chars. Line indexes are of the source text.
+    """
+    res = []
+    prev = 0
+    for (y1, y2), repl in sorted(edits, key=lambda e: tuple(e[0])):
+        if not (prev <= y1 <= y2 <= line_count):
+            raise ValueError('Formatter returned wrong line edit: (%d, %d)' % (y1, y2))
+        if isinstance(repl, str):
+            repl = repl.split('\n')
+        res.append((y1, y2, list(repl)))
+        prev = y2
+    return res
+
+
+def as_text(text, res):
+    """Get formatter result as text: line edits are applied to the source text."""
+    if not isinstance(res, list):
+        return res
+    lines = text.split('\n')
+    for y1, y2, repl in reversed(normalize_edits(res, len(lines))):
+        lines[y1:y2] = repl
+    return '\n'.join(lines)
+
+
+# texts of this size or bigger are formatted by chunks, if formatter allows it
+chunk_min_size = 1024*1024
+CHUNK_MIN_SIZE = 64*1024
+
+
+def is_chunk_start(rule, lines, i):
+    """Check that line i can begin a chunk, by chunk rule:
+        "lines": each line is independent record (CSV, JSON lines)
+        "blank": blocks separated by blank lines
+        "regex:pattern": chunk begins at line which matches the pattern,
+            e.g. "regex:\\S" for top-level records which are not indented
+    """
+    if rule == 'lines':
+        return True
+    if rule == 'blank':
+        return i > 0 and not lines[i-1].strip() and bool(lines[i].strip())
+    if rule.startswith('regex:'):
+        return re.match(rule[6:], lines[i]) is not None
+    return False
+
+
+def split_chunks(text, rule, size):
+    """Split text to chunks of approximately given size, at lines allowed by chunk rule.
+    Joined chunks give the original text."""
+    lines = text.split('\n')
+    res = []
+    cur = []
+    cur_size = 0
+    for i, line in enumerate(lines):
+        if cur and cur_size >= size and is_chunk_start(rule, lines, i):
+            res.append('\n'.join(cur)+'\n')
+            cur = []
+            cur_size = 0
+        cur.append(line)
+        cur_size += len(line)+1
+    res.append('\n'.join(cur))
+    return res
+
+
+def format_chunk(do_format, chunk):
+    """Format one chunk, keeping its trailing whitespace (EOLs, blank lines).
+    Returns None if formatter cannot format the chunk."""
+    core = chunk.rstrip()
+    if not core:
+        return chunk
+    try:
+        res = as_text(core, do_format(core))
+    except Exception:
+        # chunk may be not valid alone; entire text is formatted then
+        return None
+    if not res:
+        return None
+    return res.rstrip() + chunk[len(core):]
+
+
+def format_chunked(do_format, text):
+    """Format big text by chunks in parallel threads, and stitch the results.
+    Returns None if text cannot be split, if some chunk cannot be formatted,
+    or if chunk seams are broken after formatting; then entire text must be formatted."""
+    workers = os.cpu_count() or 1
+    size = max(CHUNK_MIN_SIZE, len(text) // (workers*4))
+    chunks = split_chunks(text, do_format.chunks, size)
+    if len(chunks) < 2:
+        return None
+
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        res = list(ex.map(lambda chunk: format_chunk(do_format, chunk), chunks))
+    if None in res:
+        return None
+
+    # check seams: each formatted chunk must still begin at allowed line
+    for i in range(1, len(res)):
+        if not res[i-1].endswith('\n'):
+            return None
+        lines = [res[i-1][:-1].rsplit('\n', 1)[-1], res[i].split('\n', 1)[0]]
+        if not is_chunk_start(do_format.chunks, lines, 1):
+            return None
+
+    return ''.join(res)
+
+
+def format_batch(do_format, texts):
+    """Format list of texts, by single call of batch function if formatter has it."""
+    if hasattr(do_format, 'format_batch'):
+        return do_format.format_batch(texts)
+    return [do_format(text) for text in texts]
+
+
+def count_changed_lines(old, new):
+    """Count of lines which differ between two texts (changed, added or deleted)."""
+    matcher = difflib.SequenceMatcher(None, old.split('\n'), new.split('\n'), autojunk=False)
+    return sum(max(i2-i1, j2-j1) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal')
+
+
+def run_timed(do_format, text):
+    """Run formatter, return (result as text, seconds, error message)."""
+    t0 = time.perf_counter()
+    try:
+        res = as_text(text, do_format(text))
+    except Exception as e:
+        return (None, time.perf_counter()-t0, str(e) or type(e).__name__)
+    return (res, time.perf_counter()-t0, '')
+
+
+def traced_peak(do_format, text):
+    """Run formatter with tracemalloc, return peak memory of Python allocations, in bytes."""
+    started = tracemalloc.is_tracing()
+    if not started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    try:
+        run_timed(do_format, text)
+        return tracemalloc.get_traced_memory()[1] - base
+    finally:
+        if not started:
+            tracemalloc.stop()
+
+
+def compare_formatters(funcs, text):
+    """Measure several formatters on the same text, without applying results.
+
+    funcs: list of (caption, formatter).
+    Formatters run one by one, so times don't include contention of other
+    formatters. For each formatter, the text is formatted: to measure time;
+    again with tracemalloc, to find peak memory (of Python allocations),
+    tracing slows it, so it's separate run; then the result is formatted,
+    to check that 2nd run gives the same text.
+    Returns list of dicts with keys: caption, sec, peak, changed, idempotent, error.
+    """
+    res = []
+    for caption, func in funcs:
+        text2, sec, error = run_timed(func, text)
+        item = {'caption': caption, 'sec': sec, 'peak': None, 'changed': None,
+            'idempotent': None, 'error': error}
+        res.append(item)
+        if error or not text2:
+            item['error'] = error or 'Cannot format text'
+            continue
+        item['changed'] = count_changed_lines(text, text2)
+        item['peak'] = traced_peak(func, text)
+
+        text3, _sec, error = run_timed(func, text2)
+        if error:
+            item['error'] = error
+        else:
+            item['idempotent'] = text3 == text2
+    return res
+
+
+def record_speed(func, size, seconds):
+
+    if size < SPEED_MIN_SIZE:
+        return
+    key = formatter_key(func)
+    rate = seconds / size
+    old = speed_stats.get(key)
+    if old is not None:
+        rate = old + (rate - old) * SPEED_AVERAGE
+    speed_stats[key] = rate
+
+
+# seconds per char for speed classes of formatters, declared by "speed=" in install.inf
+SPEED_CLASSES = {
+    'fast': 1e-7,    # ~10 Mb/s
+    'normal': 1e-6,  # ~1 Mb/s
+    'slow': 1e-5,    # ~100 Kb/s
+    }
+
+
+def predict_time(func, size, speed=''):
+    """Predicted formatting time in seconds, by measured speed of formatter,
+    or by its speed class; None if it's unknown."""
+    if not isinstance(func, str):
+        speed = speed or getattr(func, 'speed', '')
+    key = func if isinstance(func, str) else formatter_key(func)
+    rate = speed_stats.get(key)
+    if rate is None:
+        rate = SPEED_CLASSES.get(speed)
+    if rate is None:
+        return None
+    return rate * size
+
+
+def get_text_size(ed):
+    """Size of editor text in chars, for not modified file it's taken from the file.
+    Text is not copied from the editor, line lengths are summed."""
+    fn = ed.get_filename()
+    if fn and not ed.get_prop(PROP_MODIFIED):
+        try:
+            return os.path.getsize(fn)
+        except OSError:
+            pass
+    return sum(ed.get_line_len(i)+1 for i in range(ed.get_line_count()))
+
+
+def parse_size(s):
+    """Parse size like "500", "300K", "20M" to bytes; 0 for empty/wrong string."""
+    s = s.strip().upper()
+    mul = 1
+    if s.endswith('K'):
+        mul, s = 1024, s[:-1]
+    elif s.endswith('M'):
+        mul, s = 1024*1024, s[:-1]
+    try:
+        return int(float(s) * mul)
+    except ValueError:
+        return 0
+
+
+# results of speculative background formatting: (formatter key, text hash, config stamp) -> result
+precomputed = OrderedDict()
+MAX_PRECOMPUTED = 20
+
+# function(do_format, filename) -> stamp (path, mtime) of formatter config for this file,
+# or None; it's set by the plugin, which knows configs of formatters
+config_stamp = None
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+def precomputed_key(do_format, text, filename):
+    """Result depends on the text and on the config, which can be local for the file."""
+    stamp = config_stamp(do_format, filename) if config_stamp else None
+    return (formatter_key(do_format), text_hash(text), stamp)
+
+
+def put_precomputed(do_format, text, result, filename=''):
+
+    key = precomputed_key(do_format, text, filename)
+    precomputed[key] = result
+    precomputed.move_to_end(key)
+    while len(precomputed) > MAX_PRECOMPUTED:
+        precomputed.popitem(last=False)
+
+
+def get_precomputed(do_format, text, remove=True, filename=''):
+    """Get result of background formatting of this text, or None if it's not computed."""
+    key = precomputed_key(do_format, text, filename)
+    if remove:
+        return precomputed.pop(key, None)
+    return precomputed.get(key)
+
+
+def clear_precomputed():
+    precomputed.clear()
+
+
+# editor handle -> (modification version, formatter key, config stamp) after formatting
+format_states = {}
+
+
+def mark_formatted(ed, do_format, stamp=None):
+    """Remember that editor text is formatted now by this formatter with this config."""
+    h = ed.get_prop(PROP_HANDLE_SELF)
+    format_states[h] = (ed.get_prop(PROP_MODIFIED_VERSION), formatter_key(do_format), stamp)
+
+
+def clear_format_states():
+    """Forget formatted state of all editors: formatters are changed."""
+    format_states.clear()
+
+
+def is_formatted(ed, do_format, stamp=None):
+    """Check that editor text is not changed since formatting by this formatter
+    with this config. Doesn't read the editor text."""
+    h = ed.get_prop(PROP_HANDLE_SELF)
+    state = format_states.get(h)
+    if state is None:
+        return False
+    return state == (ed.get_prop(PROP_MODIFIED_VERSION), formatter_key(do_format), stamp)
+
+
+# recorder of workload descriptors (fmtreplay.Recorder), None if recording is off
+recorder = None
+
+
+def record_workload(ed, do_format, info, old=None, new=None):
+    """Pass descriptor of formatting call (dict) to the recorder, if it's on.
+    Texts old/new are saved only if recorder is configured to save them."""
+    if recorder is None:
+        return
+    info = dict(info,
+        lexer=ed.get_prop(PROP_LEXER_FILE) or '',
+        formatter=formatter_key(do_format),
+        )
+    try:
+        recorder.record(info, old, new)
+    except Exception as e:
+        print('ERROR: CudaFormatter: cannot record workload:', e)
+
+
+# worker thread for background formatting, so typing is not blocked
+bg_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cuda_fmt')
+
+
+def get_changed_ranges(ed):
+    """Get ranges (y_from, y_to_excluding) of changed/added lines, found by line states."""
+    states = ed.get_prop(PROP_LINE_STATES) or []
+    res = []
+    start = None
+    for i, state in enumerate(states):
+        if state in (LINESTATE_CHANGED, LINESTATE_ADDED):
+            if start is None:
+                start = i
+        elif start is not None:
+            res.append((start, i))
+            start = None
+    if start is not None:
+        res.append((start, len(states)))
+    return res
+
+
+def get_line_blocks(ed, ranges):
+    """Get list of (y_from, y_to_excluding, text) for given line ranges."""
+    res = []
+    for y1, y2 in ranges:
+        lines = [ed.get_text_line(y) for y in range(y1, y2)]
+        res.append((y1, y2, '\n'.join(lines)))
+    return res
+
+
+def format_blocks(do_format, blocks):
+    """Format text blocks, can run in worker thread. Returns list of new texts,
+    with None for blocks which cannot be formatted or are already formatted."""
+    res = []
+    for y1, y2, text in blocks:
+        new_text = None
+        if text.strip():
+            try:
+                # block of edited lines is often indented, e.g. body of function
+                new_text = format_indented(do_format, text)
+            except Exception:
+                # edited code is often incomplete, formatter may fail on it
+                pass
+            if new_text == text:
+                new_text = None
+        res.append(new_text)
+    return res
+
+
+def apply_blocks(ed, blocks, results):
+    """Replace line blocks by formatted texts, in single undo step.
+    Returns count of replaced blocks."""
+    items = [(b, r) for (b, r) in zip(blocks, results) if r is not None]
+    if not items:
+        return 0
+
+    carets = ed.get_carets()
+    ed.action(EDACTION_UNDOGROUP_BEGIN)
+    try:
+        # bottom to top, so line indexes of next blocks stay valid
+        for (y1, y2, text), new_text in reversed(items):
+            ed.replace(0, y1, ed.get_line_len(y2-1), y2-1, new_text)
+    finally:
+        if carets:
+            x, y = carets[0][:2]
+            # shift caret by count of lines added/deleted above it
+            delta = 0
+            for (y1, y2, text), new_text in items:
+                if y2 <= y:
+                    delta += new_text.count('\n')+1 - (y2-y1)
+            y = max(0, min(y+delta, ed.get_line_count()-1))
+            x = min(x, ed.get_line_len(y))
+            ed.set_caret(x, y)
+        ed.action(EDACTION_UNDOGROUP_END)
+    return len(items)
+
+
+def get_lexer_regions(ed):
+    """Split document to regions of sub-lexers, by lexer at the first non-space char of each line.
+
+    Returns list of (y_from, y_to_excluding, lexer). Empty lines at region edges
+    are not included to regions.
+    """
+    res = []
+    cur = None  # [y_from, y_to_excluding, lexer]
+    for y in range(ed.get_line_count()):
+        line = ed.get_text_line(y)
+        stripped = line.lstrip()
+        if not stripped:
+            continue
+        lexer = ed.get_prop(PROP_LEXER_POS, (len(line)-len(stripped), y))
+        if cur and cur[2] == lexer:
+            cur[1] = y+1
+        else:
+            cur = [y, y+1, lexer]
+            res.append(cur)
+    return [tuple(r) for r in res]
+
+
+def format_indented(do_format, text):
+    """Format text block which may be indented (e.g. embedded CSS block in HTML).
+    Common indent is removed before formatting and added back after it."""
+    lines = text.split('\n')
+    indents = [l[:len(l)-len(l.lstrip())] for l in lines if l.strip()]
+    indent = os.path.commonprefix(indents) if indents else ''
+    if indent:
+        text = '\n'.join(l[len(indent):] for l in lines)
+
+    new_text = as_text(text, do_format(text))
+    if not new_text:
+        return None
+    new_text = new_text.rstrip('\n')
+
+    if indent:
+        new_text = '\n'.join(indent+l if l else l for l in new_text.split('\n'))
+    return new_text
+
+
+def run_format_regions(ed, items, msg):
+    """Format several line blocks with their own formatters, and apply all
+    results in single undo step. Blocks of thread-safe formatters ("threads=1")
+    are formatted concurrently, others one by one in the main thread.
+
+    items: list of (y_from, y_to_excluding, do_format).
+    """
+    fmtconfig.ed_fmt = ed
+    fmtconfig.ed_filename = ed.get_filename()
+
+    blocks = get_line_blocks(ed, [(y1, y2) for (y1, y2, f) in items])
+    jobs = [(f, b[2]) for (b, (y1, y2, f)) in zip(blocks, items)]
+    threaded = [i for i, (f, text) in enumerate(jobs) if getattr(f, 'threads', False)]
+
+    def format_job(f, text):
+        try:
+            return format_indented(f, text), False
+        except Exception:
+            return None, True
+
+    ed.action(EDACTION_LOCK)
+    try:
+        app_idle(True)
+        done = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(len(threaded), os.cpu_count() or 1))) as ex:
+            futures = {i: ex.submit(format_job, *jobs[i]) for i in threaded}
+            # meanwhile, other formatters run in the main thread
+            for i, job in enumerate(jobs):
+                if i not in futures:
+                    done[i] = format_job(*job)
+        for i, future in futures.items():
+            done[i] = future.result()
+
+        results = []
+        nerr = 0
+        for i, (y1, y2, text) in enumerate(blocks):
+            new_text, failed = done[i]
+            nerr += failed
+            results.append(new_text if new_text != text else None)
+    finally:
+        ed.action(EDACTION_UNLOCK)
+
+    n = apply_blocks(ed, blocks, results)
+    if nerr:
+        msg_status(msg + _('Formatted {} of {} blocks, formatter failed on {} blocks').format(n, len(items), nerr))
+    elif n:
+        msg_status(msg + _('Formatted {} of {} blocks').format(n, len(items)))
+    else:
+        msg_status(msg + _('Text is already formatted'))
+    if n:
+        return RES_FORMATTED
+    return RES_NONE if nerr else RES_SAME
+
+
+def restore_caret(ed, carets):
+    """Restore first caret from saved carets list, keeping it in the valid range."""
+    if not carets:
+        return
+    x, y = carets[0][:2]
+    y = max(0, min(y, ed.get_line_count()-1))
+    x = min(x, ed.get_line_len(y))
+    ed.set_caret(x, y)
+
+
+def replace_lines(ed, y1, y2, lines):
+    """Replace lines y1...y2-1 (y1==y2 to insert) with given lines (without EOLs).
+    Other lines are not touched, so they keep their line states."""
+    n = ed.get_line_count()
+    if y2 < n:
+        text = ''.join(l+'\n' for l in lines)
+        if y1 == y2:
+            ed.insert(0, y1, text)
+        else:
+            ed.replace(0, y1, 0, y2, text)
+        return
+
+    # edit touches the last line, which has no EOL
+    last = n-1
+    if lines:
+        text = '\n'.join(lines)
+        if y1 < n:
+            ed.replace(0, y1, ed.get_line_len(last), last, text)
+        else:
+            ed.insert(ed.get_line_len(last), last, '\n'+text)
+    elif y1 > 0:
+        ed.delete(ed.get_line_len(y1-1), y1-1, ed.get_line_len(last), last)
+    else:
+        ed.replace(0, 0, ed.get_line_len(last), last, '')
+
+
+def apply_line_edits(ed, edits):
+    """Apply line edits in single undo step.
+
+    edits: list of (y_from, y_to_excluding, new_lines), not overlapping,
+    line indexes are of the original text.
+    """
+    if not edits:
+        return
+
+    # touching edits are joined: editor cannot have zero lines, so deleting
+    # all lines and inserting lines by separate edits would leave extra EOL
+    joined = []
+    for y1, y2, lines in sorted(edits, key=lambda e: (e[0], e[1])):
+        if joined and joined[-1][1] == y1:
+            joined[-1] = (joined[-1][0], y2, joined[-1][2]+list(lines))
+        else:
+            joined.append((y1, y2, list(lines)))
+
+    carets = ed.get_carets()
+    ed.action(EDACTION_UNDOGROUP_BEGIN)
+    try:
+        # bottom to top, so line indexes of next edits stay valid
+        for y1, y2, lines in reversed(joined):
+            replace_lines(ed, y1, y2, lines)
+    finally:
+        restore_caret(ed, carets)
+        ed.action(EDACTION_UPDATE)
+        ed.action(EDACTION_UNDOGROUP_END)
+
+
+def get_stream_edits(ed, new_lines):
+    """Get line edits from editor lines to new lines, comparing them while
+    new lines are generated. Only changed lines are kept in memory, unless
+    line count is changed (then diff of all lines is needed).
+    Returns None if formatter gave no lines: like empty text, it's failure."""
+    n = ed.get_line_count()
+    changed = {}  # index -> new line, which differs from editor line
+    count = 0
+    for i, line in enumerate(new_lines):
+        if i >= n or line != ed.get_text_line(i):
+            changed[i] = line
+        count = i+1
+
+    if count == 0:
+        return None
+
+    if count == n:
+        # merge consecutive changed lines
+        edits = []
+        for i in sorted(changed):
+            if edits and edits[-1][1] == i:
+                edits[-1][1] += 1
+                edits[-1][2].append(changed[i])
+            else:
+                edits.append([i, i+1, [changed[i]]])
+        return edits
+
+    old = [ed.get_text_line(i) for i in range(n)]
+    new = [changed[i] if i in changed else old[i] for i in range(count)]
+    matcher = difflib.SequenceMatcher(None, old, new)
+    return [(i1, i2, new[j1:j2]) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def run_format_stream(ed, do_format, msg, budget=None):
+    """Format entire text by streaming formatter: editor lines are passed
+    lazily, and output is compared with editor lines incrementally."""
+
+    n = ed.get_line_count()
+    size = sum(ed.get_line_len(i)+1 for i in range(n))
+    if size <= 1:
+        return RES_NONE
+
+    if budget is not None:
+        predicted = predict_time(do_format, size)
+        if predicted is not None and predicted > budget:
+            return RES_OVER_BUDGET
+
+    try:
+        ed.action(EDACTION_LOCK)
+        try:
+            app_idle(True)
+            t0 = time.perf_counter()
+            lines = (ed.get_text_line(i) for i in range(n))
+            edits = get_stream_edits(ed, do_format.format_lines(lines))
+            record_speed(do_format, size, time.perf_counter()-t0)
+        finally:
+            ed.action(EDACTION_UNLOCK)
+    except Exception as e:
+        msg_box(_('Formatter gave exception:') + '\n\n' + str(e), MB_OK + MB_ICONERROR)
+        return RES_NONE
+
+    if edits is None:
+        msg_status(msg + _("Cannot format text"))
+        return RES_NONE
+    if not edits:
+        msg_status(msg + _('Text is already formatted'))
+        return RES_SAME
+
+    apply_line_edits(ed, edits)
+    msg_status(msg + _("Formatted entire text"))
+    return RES_FORMATTED
+
 
 def is_selected(carets):
 
@@ -14,141 +754,406 @@ def is_selected(carets):
     return False
 
 
-def replace_all_preserving_linestates(ed, old_text, new_text):
-    """Apply changes preserving line states using hybrid approach.
+# changed lines longer than this are changed by character hunks, not entirely
+long_line_size = 1000
+MAX_TOKENS_DIFF = 20000  # more tokens: diff only by common prefix/suffix
+
+re_token = re.compile(r'\w+|\s+|[^\w\s]')
+
+
+def get_char_hunks(old, new):
+    """Get list of hunks (x_from, x_to, replacement) to change the old line to the new one.
+    Common prefix/suffix are skipped, the middle part is compared by tokens."""
+    n = min(len(old), len(new))
+    a = 0
+    while a < n and old[a] == new[a]:
+        a += 1
+    b = 0
+    while b < n-a and old[-1-b] == new[-1-b]:
+        b += 1
+    old_mid = old[a:len(old)-b]
+    new_mid = new[a:len(new)-b]
+
+    old_tokens = re_token.findall(old_mid)
+    new_tokens = re_token.findall(new_mid)
+    if not old_tokens or not new_tokens or len(old_tokens)+len(new_tokens) > MAX_TOKENS_DIFF:
+        return [(a, a+len(old_mid), new_mid)]
+
+    # char offsets of tokens
+    old_pos = [a]
+    for t in old_tokens:
+        old_pos.append(old_pos[-1]+len(t))
+
+    res = []
+    matcher = difflib.SequenceMatcher(None, old_tokens, new_tokens, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            res.append((old_pos[i1], old_pos[i2], ''.join(new_tokens[j1:j2])))
+    return res
+
+
+def replace_in_line(ed, y, old, new):
+    """Change editor line from old text to new text; long line is changed by small hunks,
+    to keep undo and repaint cost proportional to the real change."""
+    if max(len(old), len(new)) <= long_line_size:
+        ed.set_text_line(y, new)
+        return
+    for x1, x2, repl in reversed(get_char_hunks(old, new)):
+        ed.replace(x1, y, x2, y, repl)
+
 
-    Fast path (same line count): Native API - O(1) replace + O(n) comparison
-    Slow path (lines added/removed): Myers diff - O(ND)
+# cost model of applying changes to editor, in seconds: per API call of each kind,
+# and per char passed to editor; calibrated by calibrate_apply_costs()
+apply_costs = {
+    'replace': 20e-6,  # ed.replace/insert/delete call
+    'line': 10e-6,     # ed.set_text_line call
+    'state': 2e-6,     # ed.set_prop(PROP_LINE_STATE) call
+    'char': 20e-9,     # char of text passed to editor
+}
+
+
+def split_lines(text):
+    """Split text to lines by EOL chars only, ending EOL doesn't give an empty line."""
+    lines = text.split('\n')
+    if text.endswith('\n'):
+        lines.pop()
+    return lines
+
+
+def get_line_hunks(old_lines, new_lines):
+    """Get changed blocks of lines: list of (i1, i2, j1, j2), indexes of old/new lines."""
+    if len(old_lines) == len(new_lines):
+        # same line count: runs of changed lines, no diff is needed
+        res = []
+        for i in range(len(new_lines)):
+            if old_lines[i] != new_lines[i]:
+                if res and res[-1][1] == i:
+                    res[-1] = (res[-1][0], i+1, res[-1][2], i+1)
+                else:
+                    res.append((i, i+1, i, i+1))
+        return res
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    return [(i1, i2, j1, j2) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+
+def estimate_apply_costs(new_text, old_lines, new_lines, hunks):
+    """Predict time of each way to apply the changes, by the cost model.
+
+    'full': single replace of entire text, then line states are restored;
+    'hunks': each changed block of lines is replaced by one call;
+    'lines': each changed line is changed by its own call (only for the same
+    line count, otherwise it's never cheaper than 'hunks').
+    Returns dict: strategy -> seconds.
     """
-    old_lines = old_text.splitlines(keepends=False)
-    new_lines = new_text.splitlines(keepends=False)
+    c = apply_costs
+    chars = sum(len(s)+1 for i1, i2, j1, j2 in hunks for s in new_lines[j1:j2])
+    res = {
+        'full': c['replace'] + c['char']*len(new_text) + c['state']*len(new_lines),
+        'hunks': c['replace']*len(hunks) + c['char']*chars,
+        }
+    if len(old_lines) == len(new_lines):
+        res['lines'] = c['line']*sum(i2-i1 for i1, i2, j1, j2 in hunks) + c['char']*chars
+    return res
 
-    # Fast path 1: No changes at all
-    if old_text == new_text:
+
+def choose_apply_strategy(old_text, new_text, old_lines, new_lines, hunks):
+    """Choose the cheapest correct way to apply the changes, see estimate_apply_costs()."""
+    if not old_lines or old_text.endswith('\n') != new_text.endswith('\n'):
+        # only full replace keeps the ending EOL right
+        return 'full'
+    if len(old_lines) == len(new_lines) and any(
+        max(len(old_lines[i]), len(new_lines[i])) > long_line_size
+        for i1, i2, j1, j2 in hunks for i in range(i1, i2)):
+        # changes in huge lines (e.g. minified files): change them by character hunks,
+        # it also keeps undo small
+        return 'lines'
+    costs = estimate_apply_costs(new_text, old_lines, new_lines, hunks)
+    return min(costs, key=costs.get)
+
+
+def apply_full(ed, new_text, old_lines, new_lines, hunks):
+    """Replace entire text, then restore line states of unchanged lines."""
+    old_states = ed.get_prop(PROP_LINE_STATES)
+
+    line_count = ed.get_line_count()
+    last_line_len = ed.get_line_len(line_count - 1)
+    ed.replace(0, 0, last_line_len, line_count - 1, new_text)
+
+    if not old_states or len(old_states) < len(old_lines):
         return
 
+    # map unchanged new lines to old lines, between changed blocks
+    shift = {}
+    prev_i = prev_j = 0
+    for i1, i2, j1, j2 in hunks + [(len(old_lines), len(old_lines), len(new_lines), len(new_lines))]:
+        for j in range(prev_j, j1):
+            shift[j] = j - prev_j + prev_i
+        prev_i, prev_j = i2, j2
+
+    for j in range(len(new_lines)):
+        if j in shift:
+            ed.set_prop(PROP_LINE_STATE, (j, old_states[shift[j]]))
+        else:
+            ed.set_prop(PROP_LINE_STATE, (j, LINESTATE_CHANGED))
+
+
+def apply_hunks(ed, old_lines, new_lines, hunks):
+    """Replace each changed block of lines by single call, from bottom to top."""
+    for i1, i2, j1, j2 in reversed(hunks):
+        if i2-i1 == j2-j1 and any(len(s) > long_line_size for s in old_lines[i1:i2]+new_lines[j1:j2]):
+            for k in range(i2-i1):
+                replace_in_line(ed, i1+k, old_lines[i1+k], new_lines[j1+k])
+        else:
+            replace_lines(ed, i1, i2, new_lines[j1:j2])
+
+
+def apply_lines(ed, old_lines, new_lines, hunks):
+    """Change each changed line by its own call, long lines by character hunks.
+    Line count must be the same."""
+    for i1, i2, j1, j2 in hunks:
+        for i in range(i1, i2):
+            replace_in_line(ed, i, old_lines[i], new_lines[i])
+
+
+def replace_all_preserving_linestates(ed, old_text, new_text, strategy=None):
+    """Apply changes preserving line states, in the way which is cheapest by
+    the cost model (see choose_apply_strategy):
+
+    Full replace: Native API - O(1) replace + O(n) restoring of line states
+    Hunks: each changed block of lines is replaced by single call
+    Lines (same line count): each changed line is changed by its own call,
+    long ones by character hunks
+    Changed blocks are found by comparison of lines (same line count), or by
+    Myers diff - O(ND) (lines added/removed).
+    Edits path (new_text is list of line edits from formatter, see normalize_edits):
+    edits are applied directly, without diff
+
+    Strategy can be forced ('full'/'hunks'/'lines'), caller must check that
+    it's correct for these texts.
+    Returns name of used strategy, or None if nothing is changed.
+    """
+    if isinstance(new_text, list):
+        apply_line_edits(ed, normalize_edits(new_text, ed.get_line_count()))
+        return 'edits' if new_text else None
+
+    # Fast path: No changes at all
+    if old_text == new_text:
+        return None
+
+    # split only by EOLs, like the editor does (splitlines() also splits by
+    # form feed, U+2028 etc, it would give wrong line indexes);
+    # ending EOL is not a line, choose_apply_strategy() handles its change
+    old_lines = split_lines(old_text)
+    new_lines = split_lines(new_text)
+    hunks = get_line_hunks(old_lines, new_lines)
+    if strategy is None:
+        strategy = choose_apply_strategy(old_text, new_text, old_lines, new_lines, hunks)
+
     # Save caret position
     carets = ed.get_carets()
-    if carets:
-        caret_x, caret_y = carets[0][:2]
 
     # Begin undo group (all changes in single undo step)
     ed.action(EDACTION_UNDOGROUP_BEGIN)
 
     try:
-        # Fast path 2: Same line count (95% of cases)
-        # Use Native API for maximum speed
-        if len(old_lines) == len(new_lines):
-            # print('CudaFormatter: fast path, same line count')
-
-            # Save current line states
-            old_states = ed.get_prop(PROP_LINE_STATES)
-
-            # Single fast replace
-            line_count = ed.get_line_count()
-            last_line_len = ed.get_line_len(line_count - 1)
-
-            ed.replace(
-                0, 0,
-                last_line_len, line_count - 1,
-                new_text
-            )
-
-            # Restore states for unchanged lines
-            if old_states and len(old_states) >= len(old_lines):
-                unchanged_count = 0
-
-                for i in range(len(new_lines)):
-                    if i < len(old_lines) and old_lines[i] == new_lines[i]:
-                        # Line unchanged, restore old state
-                        ed.set_prop(PROP_LINE_STATE, (i, old_states[i]))
-                        unchanged_count += 1
-                    else:
-                        # Line changed, mark as changed
-                        ed.set_prop(PROP_LINE_STATE, (i, LINESTATE_CHANGED))
-
-            return
-
-        # Slow path: Line count changed (5% of cases)
-        # Use Myers diff algorithm for perfect accuracy
-        # print('CudaFormatter: slow path')
-
-        matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
-        opcodes = list(matcher.get_opcodes())
-
-        # Apply changes from TOP to BOTTOM with offset tracking
-        offset = 0  # Track how much we've shifted
-
-        for tag, i1, i2, j1, j2 in opcodes:
-            if tag == 'equal':
+        if strategy == 'full':
+            apply_full(ed, new_text, old_lines, new_lines, hunks)
+        elif strategy == 'hunks':
+            apply_hunks(ed, old_lines, new_lines, hunks)
+        else:
+            apply_lines(ed, old_lines, new_lines, hunks)
+
+    finally:
+        # Restore caret position
+        restore_caret(ed, carets)
+
+        ed.action(EDACTION_UPDATE)
+
+        # End undo group
+        ed.action(EDACTION_UNDOGROUP_END)
+
+    return strategy
+
+
+def calibrate_apply_costs(ed, line_count=5000, width=60):
+    """Measure costs of editor API calls on given (scratch) editor, for the cost
+    model of applying changes. Editor text is replaced. Returns dict like apply_costs."""
+
+    line = 'x'*width
+    text = '\n'.join([line]*line_count)
+    ed.set_text_all(text)
+    step = max(1, line_count // 1000)
+    ys = range(0, line_count, step)
+
+    # full replace: cost per char
+    t0 = time.perf_counter()
+    for i in range(3):
+        last = ed.get_line_count()-1
+        ed.replace(0, 0, ed.get_line_len(last), last, text.replace('x', 'yz'[i % 2]))
+    char = (time.perf_counter()-t0) / (3*len(text))
+
+    def per_call(func):
+        t0 = time.perf_counter()
+        for y in ys:
+            func(y)
+        return (time.perf_counter()-t0) / len(ys)
+
+    replace = per_call(lambda y: ed.replace(0, y, width, y, line))
+    text_line = per_call(lambda y: ed.set_text_line(y, line))
+    state = per_call(lambda y: ed.set_prop(PROP_LINE_STATE, (y, LINESTATE_CHANGED)))
+
+    tiny = 1e-9
+    return {
+        'replace': max(tiny, replace - char*width),
+        'line': max(tiny, text_line - char*width),
+        'state': max(tiny, state),
+        'char': max(tiny, char),
+        }
+
+
+def get_selections(ed, carets):
+    """Get non-empty selections, from bottom to top, to replace them in this order.
+    Returns list of (x0, y0, x1, y1, text, with_eol); text is without the ending EOLs."""
+    sels = []
+    for x0, y0, x1, y1 in reversed(carets):
+        if y1<0: continue
+        if (y0, x0)>(y1, x1):
+            x0, y0, x1, y1 = x1, y1, x0, y0
+
+        text1 = ed.get_text_substr(x0, y0, x1, y1)
+        if not text1.strip():
+            continue
+
+        with_eol = text1.endswith('\n')
+        if with_eol:
+            text1 = text1.rstrip('\n')
+        sels.append((x0, y0, x1, y1, text1, with_eol))
+    return sels
+
+
+def apply_selections(ed, sels, texts):
+    """Replace selections (from bottom to top, see get_selections) with formatter results,
+    in single undo step. Returns count of changed selections."""
+    nsel = 0
+    ed.action(EDACTION_UNDOGROUP_BEGIN)
+    try:
+        for (x0, y0, x1, y1, text1, with_eol), text in zip(sels, texts):
+            text = as_text(text1, text)
+            if not text:
                 continue
+            if text==text1:
+                continue
+
+            if with_eol:
+                text += '\n'
+
+            ed.set_caret(x0, y0)
+            ed.replace(x0, y0, x1, y1, text)
+            nsel += 1
+    finally:
+        ed.action(EDACTION_UNDOGROUP_END)
+    return nsel
 
-            # Adjust indices with current offset
-            adj_i1 = i1 + offset
-            adj_i2 = i2 + offset
 
-            if tag == 'replace':
-                # Delete old lines
-                for _ in range(i2 - i1):
-                    ed.delete(0, adj_i1, 0, adj_i1 + 1)
+# editor handle -> (modification version, dict of position -> lexer)
+lexer_pos_cache = {}
 
-                # Insert new lines
-                for idx in range(j1, j2):
-                    ed.insert(0, adj_i1, new_lines[idx] + '\n')
-                    adj_i1 += 1  # Move insertion point down
 
-                # Update offset: removed (i2-i1) lines, added (j2-j1) lines
-                offset += (j2 - j1) - (i2 - i1)
+def lexer_at(ed, x, y):
+    """Get lexer at position by PROP_LEXER_POS; results are cached until the text is changed."""
+    h = ed.get_prop(PROP_HANDLE_SELF)
+    version = ed.get_prop(PROP_MODIFIED_VERSION)
+    item = lexer_pos_cache.get(h)
+    if item is None or item[0] != version:
+        item = (version, {})
+        lexer_pos_cache[h] = item
+    cache = item[1]
+    if (x, y) not in cache:
+        cache[(x, y)] = ed.get_prop(PROP_LEXER_POS, (x, y))
+    return cache[(x, y)]
 
-            elif tag == 'delete':
-                for _ in range(i2 - i1):
-                    ed.delete(0, adj_i1, 0, adj_i1 + 1)
 
-                # Update offset
-                offset -= (i2 - i1)
+def get_selection_lexer(ed, x0, y0, x1, y1):
+    """Get lexer of selection (with ordered ends), or None if selection
+    overlaps sub-lexer blocks. Gives '' in editor without lexer."""
+    # decrease ending pos, it's often after the sub-lexer ending
+    if x1 > 0:
+        x1 -= 1
+    elif y1 > 0:
+        y1 -= 1
+        x1 = ed.get_line_len(y1)
 
-            elif tag == 'insert':
-                for idx in range(j1, j2):
-                    ed.insert(0, adj_i1, new_lines[idx] + '\n')
-                    adj_i1 += 1
+    lexer = lexer_at(ed, x0, y0) or ''
+    if (lexer_at(ed, x1, y1) or '') != lexer:
+        return None
+    return lexer
 
-                # Update offset
-                offset += (j2 - j1)
 
-        # Ensure last line has newline (Myers may miss it)
-        if new_text.endswith('\n'):
-            last_line_idx = ed.get_line_count() - 1
-            last_line_text = ed.get_text_line(last_line_idx)
-            last_line_len = ed.get_line_len(last_line_idx)
+def run_format_groups(ed, groups, msg):
+    """Format selections by different formatters: groups is list of
+    (do_format, sels), sels are items of get_selections(). Each group is
+    formatted by one batch call, all results are applied in single undo step.
+    Returns one of RES_xxx values.
+    """
+    if ed.get_sel_mode() != SEL_NORMAL:
+        msg_status(msg + _("Column selection is not supported"))
+        return RES_NONE
 
-            # Replace last line with itself + newline
-            ed.replace(0, last_line_idx, last_line_len, last_line_idx, last_line_text + '\n')
+    fmtconfig.ed_fmt = ed
+    fmtconfig.ed_filename = ed.get_filename()
 
+    results = {}  # selection position -> result
+    error = None
+    ed.action(EDACTION_LOCK)
+    try:
+        app_idle(True)
+        for do_format, sels in groups:
+            texts1 = [sel[4] for sel in sels]
+            t0 = time.perf_counter()
+            try:
+                texts = format_batch(do_format, texts1)
+            except Exception as e:
+                error = error or e
+                continue
+            record_speed(do_format, sum(map(len, texts1)), time.perf_counter()-t0)
+            for sel, text in zip(sels, texts):
+                results[sel[:4]] = text
     finally:
-        # Restore caret position
-        if carets:
-            # Ensure caret is within valid range
-            new_line_count = ed.get_line_count()
-            if caret_y >= new_line_count:
-                caret_y = new_line_count - 1
+        ed.action(EDACTION_UNLOCK)
 
-            new_line_len = ed.get_line_len(caret_y)
-            if caret_x > new_line_len:
-                caret_x = new_line_len
+    sels = sorted((sel for _f, items in groups for sel in items), key=lambda s: (s[1], s[0]), reverse=True)
+    nsel = apply_selections(ed, sels, [results.get(sel[:4]) for sel in sels])
 
-            ed.set_caret(caret_x, caret_y)
+    res = RES_FORMATTED if nsel else RES_NONE
+    for do_format, items in groups:
+        record_workload(ed, do_format, {
+            'mode': 'sel',
+            'sels': len(items),
+            'groups': len(groups),
+            'size': sum(len(sel[4]) for sel in items),
+            'result': res,
+            })
 
-        ed.action(EDACTION_UPDATE)
+    if error is not None:
+        msg_box(_('Formatter gave exception:') + '\n\n' + str(error), MB_OK + MB_ICONERROR)
+    if nsel:
+        msg_status(msg + _("Formatted {} selections").format(nsel))
+    else:
+        msg_status(msg + _("Cannot format selection(s)"))
+    return res
 
-        # End undo group
-        ed.action(EDACTION_UNDOGROUP_END)
 
+def run_format(ed, do_format, msg, force_all, budget=None):
+    """Format selection(s) or entire text of editor.
 
-def run_format(ed, do_format, msg, force_all):
+    If budget (in seconds) is given, entire text is not formatted when predicted
+    formatting time exceeds it, and RES_OVER_BUDGET is returned.
+    Returns one of RES_xxx values.
+    """
 
     if ed.get_sel_mode() != SEL_NORMAL:
         msg_status(msg + _("Column selection is not supported"))
-        return
+        return RES_NONE
 
     fmtconfig.ed_fmt = ed
     fmtconfig.ed_filename = ed.get_filename()
@@ -157,38 +1162,23 @@ def run_format(ed, do_format, msg, force_all):
     use_all = force_all or not is_selected(carets)
 
     if not use_all:
-        nsel = 0
-        for x0, y0, x1, y1 in reversed(carets):
-            if y1<0: continue
-            if (y0, x0)>(y1, x1):
-                x0, y0, x1, y1 = x1, y1, x0, y0
-
-            text1 = ed.get_text_substr(x0, y0, x1, y1)
-            if not text1.strip():
-                continue
-
-            with_eol = text1.endswith('\n')
-            if with_eol:
-                text1 = text1.rstrip('\n')
-
+        sels = get_selections(ed, carets)
+        texts1 = [sel[4] for sel in sels]
+        format_sec = 0
+        if texts1:
             ed.action(EDACTION_LOCK)
             try:
                 app_idle(True)
-                text = do_format(text1)
+                t0 = time.perf_counter()
+                texts = format_batch(do_format, texts1)
+                format_sec = time.perf_counter()-t0
+                record_speed(do_format, sum(map(len, texts1)), format_sec)
             finally:
                 ed.action(EDACTION_UNLOCK)
+        else:
+            texts = []
 
-            if not text:
-                continue
-            if text==text1:
-                continue
-
-            if with_eol:
-                text += '\n'
-
-            ed.set_caret(x0, y0)
-            ed.replace(x0, y0, x1, y1, text)
-            nsel += 1
+        nsel = apply_selections(ed, sels, texts)
 
         if nsel>1:
             msg_status(msg + _("Formatted {} selections").format(nsel))
@@ -196,32 +1186,86 @@ def run_format(ed, do_format, msg, force_all):
             msg_status(msg + _("Formatted selection"))
         else:
             msg_status(msg + _("Cannot format selection(s)"))
+        res = RES_FORMATTED if nsel else RES_NONE
+        record_workload(ed, do_format, {
+            'mode': 'sel',
+            'sels': len(texts1),
+            'changed_sels': nsel,
+            'size': sum(map(len, texts1)),
+            'format_sec': format_sec,
+            'result': res,
+            })
+        return res
 
     else:
         # format entire file
-        x0, y0, x1, y1 = carets[0]
+        if getattr(do_format, 'stream', False):
+            res = run_format_stream(ed, do_format, msg, budget)
+            record_workload(ed, do_format, {
+                'mode': 'stream',
+                'lines': ed.get_line_count(),
+                'result': res,
+                })
+            return res
+
         text1 = ed.get_text_all()
         if not text1.strip():
-            return
+            return RES_NONE
 
-        try:
-            ed.action(EDACTION_LOCK)
+        text = get_precomputed(do_format, text1, filename=fmtconfig.ed_filename) if precomputed else None
+        format_sec = 0
+
+        if text is None and budget is not None:
+            predicted = predict_time(do_format, len(text1))
+            if predicted is not None and predicted > budget:
+                return RES_OVER_BUDGET
+
+        if text is None:
             try:
-                app_idle(True)
-                text = do_format(text1)
-            finally:
-                ed.action(EDACTION_UNLOCK)
-        except Exception as e:
-            msg_box(_('Formatter gave exception:') + '\n\n' + str(e), MB_OK + MB_ICONERROR)
-            return
+                ed.action(EDACTION_LOCK)
+                try:
+                    app_idle(True)
+                    t0 = time.perf_counter()
+                    if getattr(do_format, 'chunks', '') and len(text1) >= chunk_min_size:
+                        text = format_chunked(do_format, text1)
+                    if text is None:
+                        text = do_format(text1)
+                    format_sec = time.perf_counter()-t0
+                    record_speed(do_format, len(text1), format_sec)
+                finally:
+                    ed.action(EDACTION_UNLOCK)
+            except Exception as e:
+                msg_box(_('Formatter gave exception:') + '\n\n' + str(e), MB_OK + MB_ICONERROR)
+                return RES_NONE
 
-        if not text:
-            msg_status(msg + _("Cannot format text"))
-            return
+        info = {
+            'mode': 'all',
+            'size': len(text1),
+            'lines': text1.count('\n')+1,
+            'format_sec': format_sec,
+            }
 
-        if text==text1:
+        if isinstance(text, list):
+            # line edits
+            info['edits'] = len(text)
+            if not text:
+                msg_status(msg + _('Text is already formatted'))
+                record_workload(ed, do_format, dict(info, result=RES_SAME), text1, text1)
+                return RES_SAME
+        elif not text:
+            msg_status(msg + _("Cannot format text"))
+            return RES_NONE
+        elif text==text1:
             msg_status(msg + _('Text is already formatted'))
-            return
+            record_workload(ed, do_format, dict(info, result=RES_SAME), text1, text1)
+            return RES_SAME
+        else:
+            info['new_size'] = len(text)
+            info['new_lines'] = text.count('\n')+1
 
-        replace_all_preserving_linestates(ed, text1, text)
+        t0 = time.perf_counter()
+        info['apply'] = replace_all_preserving_linestates(ed, text1, text)
+        info['apply_sec'] = time.perf_counter()-t0
         msg_status(msg + _("Formatted entire text"))
+        record_workload(ed, do_format, dict(info, result=RES_FORMATTED), text1, text)
+        return RES_FORMATTED